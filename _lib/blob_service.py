@@ -1,13 +1,14 @@
 import os, uuid
+import gzip
+import functools
 import logging
 import json
 import time
 import re
-from decimal import Decimal
-from datetime import datetime
-from azure.storage.queue import TextBase64DecodePolicy, TextBase64EncodePolicy
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
 from azure.storage.blob import BlobServiceClient
-from queue_service import get_queue_service
+from _lib.queue_service import get_queue_client
+from _lib.codec import serialize, deserialize, ExtendedEncoder, ExtendedDecoder, DATE_TIME_FORMAT
 
 DEFAULT_ACCOUNT_NAME = os.environ["AzureStorageName"]
 DEFAULT_ACCOUNT_KEY = os.environ["AzureStorageKey"]
@@ -35,17 +36,12 @@ def put_blob_to_queue(queue_name, blob_container, data, key_mapper, **kwargs):
     key = key_mapper(data)
     if not key:
         raise KeyError()
-    get_blob_service().get_blob_client(blob_container).upload_blob(json.dumps("data, indent=4"))
-    queue_client = get_queue_service().get_queue_client(
-                                        queue_name,
-                                        message_encode_policy = TextBase64EncodePolicy(),
-                                        message_decode_policy = TextBase64DecodePolicy()
-                                        )
-    queue_client.send_message(key)
+    get_blob_service().get_blob_client(blob_container, key).upload_blob(json.dumps(data, indent=4), overwrite=True)
+    get_queue_client(queue_name).send_message(key)
 
 
 def get_blob_from_queue(blob_container, name, account=DEFAULT_ACCOUNT_NAME, **kwargs):
-    return get_blob_service(account=account).get_blob_client(blob_container).get_blob_to_text(name)
+    return get_blob_service(account=account).get_blob_client(blob_container, name).download_blob().readall().decode("utf-8")
 
 
 
@@ -58,46 +54,96 @@ def get_any_blob_from_queue(path, **kwargs):
     This function is more versatile than 'get_blob_from_queue' as it also gets the
     account and container from the message allowing the it to dynamically
     pick a storage account and container to fetch data from.
+    Claim check pointers (see check_in) are resolved to the original message.
     """
+    claim_check = parse_claim_check(path)
+    if claim_check:
+        return check_out(claim_check)
     account, blob_container, name = path.split("/", maxsplit=2)
-    return get_blob_service(account=account).get_blob_client(blob_container).get_blob_to_text(name)
+    return get_blob_from_queue(blob_container, name, account=account)
 
 
 def delete_blob(path, **kwargs):
     account, blob_container, name = path.split("/", maxsplit=2)
-    return get_blob_service(account=account).get_blob_client(blob_container).delete_blob(name)
+    return get_blob_service(account=account).get_blob_client(blob_container, name).delete_blob()
 
 
-# json.dumps that supports Decimal and datetime
-def serialize(item):
-    return json.dumps(item, cls=ExtendedEncoder)
+# Claim check: messages too large for a storage queue are stored gzipped in blob storage
+# and a small pointer is queued in their place.
+CLAIM_CHECK_CONTAINER = "claim-checks"
+CLAIM_CHECK_KEY = "_claim_check"
 
+CONTAINERS_CREATED = set()
 
-# json.loads that supports Decimal and datetime
-def deserialize(string):
-    return json.loads(string, cls=ExtendedDecoder)
 
+def check_in(queue_name, message, account=DEFAULT_ACCOUNT_NAME) -> str:
+    """
+    Uploads the message gzipped to the claim check container and returns the pointer to queue instead.
+    """
+    blob_service = get_blob_service(account=account)
+    if (account, CLAIM_CHECK_CONTAINER) not in CONTAINERS_CREATED:
+        try:
+            blob_service.create_container(CLAIM_CHECK_CONTAINER)
+        except ResourceExistsError:
+            pass
+        CONTAINERS_CREATED.add((account, CLAIM_CHECK_CONTAINER))
+    name = f"{queue_name}/{uuid.uuid4()}.json.gz"
+    data = gzip.compress(message.encode("utf-8"))
+    blob_service.get_blob_client(CLAIM_CHECK_CONTAINER, name).upload_blob(data)
+    logging.info("Claim checked %d byte message for %s as %d bytes in %s", len(message), queue_name, len(data), name)
+    return json.dumps({CLAIM_CHECK_KEY: full_blob_path(CLAIM_CHECK_CONTAINER, name, account), "encoding": "gzip"})
+
+
+# Returns the pointer in a message, or None when the message isn't a claim check.
+def parse_claim_check(message):
+    if not isinstance(message, str) or not message.startswith("{") or CLAIM_CHECK_KEY not in message:
+        return None
+    try:
+        pointer = json.loads(message)
+    except ValueError:
+        return None
+    if isinstance(pointer, dict) and set(pointer) == {CLAIM_CHECK_KEY, "encoding"}:
+        return pointer
+    return None
+
+
+def check_out(claim_check) -> str:
+    account, blob_container, name = claim_check[CLAIM_CHECK_KEY].split("/", maxsplit=2)
+    data = get_blob_service(account=account).get_blob_client(blob_container, name).download_blob().readall()
+    if claim_check["encoding"] == "gzip":
+        data = gzip.decompress(data)
+    return data.decode("utf-8")
+
+
+# Returns the original message, from blob storage if the message is a claim check.
+def resolve_message(message) -> str:
+    claim_check = parse_claim_check(message)
+    if claim_check:
+        return check_out(claim_check)
+    return message
+
+
+def delete_claim_check(message):
+    claim_check = parse_claim_check(message)
+    if claim_check:
+        try:
+            delete_blob(claim_check[CLAIM_CHECK_KEY])
+        except ResourceNotFoundError:
+            pass
+
+
+def claim_checked(handler):
+    """
+    Decorates a queue handler taking the message text. The handler gets the original message,
+    and the claim check blob is deleted once the handler returned without raising.
+    A failing handler keeps the blob, so the message can still be retried or replayed from poison.
+    """
 
-DATE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
-
-
-class ExtendedDecoder(json.JSONDecoder):
-    def __init__(self, *args, **kwargs):
-        json.JSONDecoder.__init__(self, object_hook=self.object_hook, *args, **kwargs)
-
-    def object_hook(self, o):
-        if o.get("_type") == "datetime":
-            return datetime.strptime(o["value"], DATE_TIME_FORMAT)
-        if o.get("_type") == "decimal":
-            return Decimal(o["value"])
-        return o
-
+    @functools.wraps(handler)
+    def wrapper(message, *args, **kwargs):
+        result = handler(resolve_message(message), *args, **kwargs)
+        delete_claim_check(message)
+        return result
 
-class ExtendedEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, Decimal):
-            return {"_type": "decimal", "value": str(o)}
-        if isinstance(o, datetime):
-            return {"_type": "datetime", "value": o.strftime(DATE_TIME_FORMAT)}
-        return super().default(o)
+    return wrapper
 
@@ -0,0 +1,160 @@
+"""
+JSON codec for queue messages and blobs that round-trips Decimal and datetime.
+
+Decimal and datetime values are written as tagged strings, an escape character followed by a one letter tag:
+    Decimal("1.50")                  -> "\\u001bd1.50"
+    datetime(2023, 5, 1, 10, 0, 0)   -> "\\u001bt2023-05-01T10:00:00"
+Datetimes are written with isoformat, so microseconds and timezones survive the round trip.
+Strings that themselves start with the escape character are written with the "s" tag.
+
+deserialize still reads the {"_type": "decimal", "value": ...} objects written by ExtendedEncoder,
+so messages and blobs written before this module are read back the same.
+
+Encoding always uses the standard library json module. Decoding uses orjson when it is installed, and
+json.loads for anything orjson would read differently: documents it rejects (NaN, Infinity, lone
+surrogates) and integers that don't fit in 64 bits, which orjson turns into floats. Results are the same
+with or without orjson, except that orjson also reads documents nested deeper than json's recursion limit.
+orjson isn't used for encoding because it writes NaN as null and serializes UUIDs, enums and dataclasses
+that json rejects, which can't be caught without walking the item.
+"""
+import json
+from decimal import Decimal
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:  # Optional, deserialize uses json.loads without it.
+    orjson = None
+
+
+ESCAPE = "\x1b"
+DECIMAL_TAG = ESCAPE + "d"
+DATETIME_TAG = ESCAPE + "t"
+STRING_TAG = ESCAPE + "s"
+
+# How the escape character looks in encoded JSON. json and orjson write it lowercase, other encoders may not.
+ENCODED_ESCAPES = ("\\u001b", "\\u001B")
+LEGACY_TYPE_KEY = '"_type"'
+
+SEPARATORS = (",", ":")
+
+# 19 digits in a row may be an integer outside the 64 bit range, long digit runs in strings match too.
+# Searched for in a copy of the UTF-8 text with digits mapped to "0" and everything else to " ", a regex is much slower.
+LONG_INTEGER = b"0" * 19
+DIGIT_MASK = bytes(ord("0") if chr(i).isdigit() and i < 128 else ord(" ") for i in range(256))
+
+
+# json.dumps that supports Decimal and datetime
+def serialize(item) -> str:
+    tagged = [0]
+
+    def default(o):
+        if isinstance(o, Decimal):
+            tagged[0] += 1
+            return DECIMAL_TAG + str(o)
+        if isinstance(o, datetime):
+            tagged[0] += 1
+            return DATETIME_TAG + o.isoformat()
+        raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+    text = dumps(item, default)
+    if text.count("\\u001b") != tagged[0]:
+        # Some string in item contains the escape character, tag the ones that would be read back as tagged values.
+        tagged[0] = 0
+        text = dumps(escape_strings(item), default)
+    return text
+
+
+def dumps(item, default) -> str:
+    return json.dumps(item, default=default, separators=SEPARATORS)
+
+
+def escape_strings(item):
+    if isinstance(item, str):
+        return STRING_TAG + item if item.startswith(ESCAPE) else item
+    if isinstance(item, dict):
+        return {key: escape_strings(value) for key, value in item.items()}
+    if isinstance(item, (list, tuple)):
+        return [escape_strings(value) for value in item]
+    return item
+
+
+# json.loads that supports Decimal and datetime
+def deserialize(string):
+    if isinstance(string, (bytes, bytearray)):
+        string = string.decode("utf-8")
+    if LEGACY_TYPE_KEY in string:
+        legacy = [False]
+
+        def object_hook(o):
+            converted = legacy_object_hook(o)
+            legacy[0] = legacy[0] or converted is not o
+            return converted
+
+        item = json.loads(string, object_hook=object_hook)
+        if legacy[0]:
+            return item  # Written by ExtendedEncoder, which left strings as they were.
+    else:
+        item = loads(string)
+    if any(escape in string for escape in ENCODED_ESCAPES):
+        item = untag(item)
+    return item
+
+
+def loads(string):
+    if orjson and LONG_INTEGER not in string.encode("utf-8", "surrogatepass").translate(DIGIT_MASK):
+        try:
+            return orjson.loads(string)
+        except ValueError:  # JSONDecodeError, or UnicodeEncodeError for lone surrogates.
+            pass  # json.loads accepts more, or raises the same error as before.
+    return json.loads(string)
+
+
+def untag(item):
+    if isinstance(item, str):
+        return untag_string(item) if item.startswith(ESCAPE) else item
+    if isinstance(item, dict):
+        return {key: untag(value) for key, value in item.items()}
+    if isinstance(item, list):
+        return [untag(value) for value in item]
+    return item
+
+
+def untag_string(string):
+    tag, value = string[:2], string[2:]
+    if tag == DECIMAL_TAG:
+        return Decimal(value)
+    if tag == DATETIME_TAG:
+        return datetime.fromisoformat(value)
+    if tag == STRING_TAG:
+        return value
+    return string
+
+
+# The format written by ExtendedEncoder, kept so older messages and blobs can still be read.
+DATE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def legacy_object_hook(o):
+    if o.get("_type") == "datetime":
+        return datetime.strptime(o["value"], DATE_TIME_FORMAT)
+    if o.get("_type") == "decimal":
+        return Decimal(o["value"])
+    return o
+
+
+class ExtendedDecoder(json.JSONDecoder):
+    def __init__(self, *args, **kwargs):
+        json.JSONDecoder.__init__(self, object_hook=self.object_hook, *args, **kwargs)
+
+    def object_hook(self, o):
+        return legacy_object_hook(o)
+
+
+class ExtendedEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, Decimal):
+            return {"_type": "decimal", "value": str(o)}
+        if isinstance(o, datetime):
+            return {"_type": "datetime", "value": o.strftime(DATE_TIME_FORMAT)}
+        return super().default(o)
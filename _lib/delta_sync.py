@@ -0,0 +1,117 @@
+"""
+delta_sync.py
+
+Incremental sync of Lime objects into the Cosmos datalake.
+A high-water mark of the latest seen _timestamp is kept per objectType in Table Storage,
+so every run only requests the objects changed since the previous one.
+
+The mark never passes the start of the run minus SYNC_SKEW_MARGIN. Objects written while a run pages through
+the results, or stamped by a Lime clock running behind, can have an older _timestamp than the latest one seen,
+and would otherwise fall below the mark and never be synced.
+"""
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from dateutil.parser import isoparse
+from pymongo import ReplaceOne
+from azure.common import AzureMissingResourceHttpError
+from _lib.cosmos import datalake
+from _lib.rest_template import iter_all_objects
+from _lib.table_service import get_table_service
+from _lib.transform import iter_chunks
+
+WATERMARK_TABLE = "syncwatermarks"
+WATERMARK_PARTITION = "lime"
+
+# Example from Lime. Update to the timestamp filter of your consumed REST Service.
+# Greater or equal, so objects sharing the watermark's timestamp aren't missed. Upserts make the overlap harmless.
+TIMESTAMP_FILTER = "_timestamp[gte]"
+
+UPSERT_BATCH_SIZE = 100
+
+# Seconds. Longest a write can take to become visible in the REST Service, plus the clock skew between Lime and us.
+SYNC_SKEW_MARGIN = timedelta(seconds=float(os.environ.get("DeltaSyncSkewMargin", 300)))
+
+TABLE_CREATED = False
+
+
+def get_watermark_table():
+    global TABLE_CREATED
+    table_service = get_table_service()
+    if not TABLE_CREATED:
+        table_service.create_table(WATERMARK_TABLE, fail_on_exist=False)
+        TABLE_CREATED = True
+    return table_service
+
+
+def get_watermark(objectType):
+    try:
+        entity = get_watermark_table().get_entity(WATERMARK_TABLE, WATERMARK_PARTITION, objectType)
+    except AzureMissingResourceHttpError:
+        return None
+    return entity.get("timestamp")
+
+
+def set_watermark(objectType, timestamp):
+    get_watermark_table().insert_or_replace_entity(
+        WATERMARK_TABLE,
+        {"PartitionKey": WATERMARK_PARTITION, "RowKey": objectType, "timestamp": timestamp},
+    )
+
+
+def latest_timestamp(current, objects):
+    for item in objects:
+        timestamp = item.get("timestamp")
+        if timestamp and (current is None or isoparse(timestamp) > isoparse(current)):
+            current = timestamp
+    return current
+
+
+def capped_timestamp(timestamp, cap):
+    """Returns timestamp, or cap when timestamp is later. Timestamps without a timezone are read as UTC."""
+    parsed = isoparse(timestamp)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return timestamp if parsed <= cap else cap.isoformat()
+
+
+def upsert(collection, objects):
+    operations = [ReplaceOne({"id": item["id"]}, item, upsert=True) for item in objects]
+    if operations:
+        datalake(collection).bulk_write(operations, ordered=False)
+
+
+def sync_object_type(objectType, collection=None, page_size=40, full=False):
+    """
+    Upserts every objectType object changed since the last run into the datalake.
+
+    The watermark is only moved once all pages are written, so a failed run is retried from the
+    previous mark by the next one. It is capped at the run start minus SYNC_SKEW_MARGIN, objects
+    changed after that are requested again by the next run.
+
+    :param collection: datalake collection, defaults to objectType
+    :param full: ignore the stored watermark and sync every object
+    """
+    collection = collection or objectType
+    watermark = None if full else get_watermark(objectType)
+    params = {TIMESTAMP_FILTER: watermark} if watermark else None
+    logging.info("Syncing %s changed since %s into %s", objectType, watermark, collection)
+
+    cap = datetime.now(timezone.utc) - SYNC_SKEW_MARGIN
+    latest = watermark
+    count = 0
+    for objects in iter_chunks(iter_all_objects(objectType, page_size, params=params), UPSERT_BATCH_SIZE):
+        upsert(collection, objects)
+        latest = latest_timestamp(latest, objects)
+        count += len(objects)
+
+    if latest:
+        latest = capped_timestamp(latest, cap)
+    if latest and latest != watermark:
+        set_watermark(objectType, latest)
+    logging.info("Synced %d %s objects, watermark is now %s", count, objectType, latest)
+    return {"objectType": objectType, "upserted": count, "watermark": latest}
+
+
+def sync_all(objectTypes, full=False):
+    return [sync_object_type(objectType, full=full) for objectType in objectTypes]
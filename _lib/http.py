@@ -1,10 +1,20 @@
+import os
+import atexit
+import asyncio
+import contextlib
+import copy
 import logging
 import socket
+import threading
+import time
+import backoff
 import requests
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 import aiohttp
 from urllib3.connection import HTTPConnection
 import functools
-from collections import defaultdict
+from concurrent.futures import Future
 from requests.adapters import HTTPAdapter
 
 
@@ -43,8 +53,245 @@ class HTTPAdapterWithTCPKeepalive(HTTPAdapterWithSocketOptions):
         super(HTTPAdapterWithTCPKeepalive, self).__init__(*args, **kwargs)
 
 
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails calls to a host fast after failure_threshold consecutive failures.
+    After reset_timeout seconds one probe call is let through, its result closes or reopens the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=30):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return
+            # Also lets a new probe through when the previous one never reported back.
+            if time.monotonic() >= self.opened_at + self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                self.opened_at = time.monotonic()
+                return
+        raise CircuitOpenError(f"Circuit for {self.host} is open")
+
+    def succeeded(self):
+        with self.lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    logging.warning("Opening circuit for %s after %d failures", self.host, self.failures)
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("HttpBreakerFailureThreshold", 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("HttpBreakerResetTimeout", 30))
+BACKOFF_MAX_TRIES = int(os.environ.get("HttpBackoffMaxTries", 3))
+BACKOFF_MAX_VALUE = float(os.environ.get("HttpBackoffMaxValue", 10))  # Longest single wait in seconds.
+
+# Responses that count as a failing host, and are retried for idempotent methods.
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+RETRY_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+# Throttled responses mean the host is up but wants callers to slow down. They are returned to the caller
+# as is, neither retried nor counted against the host, so the caller's own throttling (AIMDLimiter) handles them.
+THROTTLE_STATUS_CODE = 429
+
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(url) -> CircuitBreaker:
+    host = urlsplit(url).netloc
+    with BREAKERS_LOCK:
+        if host not in BREAKERS:
+            BREAKERS[host] = CircuitBreaker(host, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        return BREAKERS[host]
+
+
+def is_throttled(status, headers):
+    return status == THROTTLE_STATUS_CODE or bool(headers and headers.get("Retry-After"))
+
+
+def log_backoff(details):
+    logging.info("Retrying %s in %.1fs after %d tries", details["target"].__name__, details["wait"], details["tries"])
+
+
+class RetryableResponse(Exception):
+    def __init__(self, response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+class HTTPAdapterWithCircuitBreaker(HTTPAdapterWithTCPKeepalive):
+    """
+    Sends through the host's CircuitBreaker and retries idempotent requests on connection errors
+    and 5xx responses with exponential, fully jittered backoff.
+    When retries run out the last response is returned as is. Throttled responses are returned right away.
+    """
+
+    def send(self, request, **kwargs):
+        breaker = get_breaker(request.url)
+        discarded = []
+        max_tries = BACKOFF_MAX_TRIES if request.method in RETRY_METHODS else 1
+        send = backoff.on_exception(
+            backoff.expo,
+            (requests.exceptions.ConnectionError, requests.exceptions.Timeout, RetryableResponse),
+            max_tries=max_tries,
+            max_value=BACKOFF_MAX_VALUE,
+            jitter=backoff.full_jitter,
+            giveup=lambda e: isinstance(e, CircuitOpenError),
+            on_backoff=log_backoff,
+            logger=None,
+        )(self.send_once)
+        try:
+            return send(breaker, request, discarded, **kwargs)
+        except RetryableResponse as e:
+            return e.response
+
+    # discarded holds the response of the previous attempt, closed here so its connection goes back to the pool.
+    def send_once(self, breaker, request, discarded, **kwargs):
+        while discarded:
+            discarded.pop().close()
+        breaker.allow()
+        try:
+            res = super(HTTPAdapterWithCircuitBreaker, self).send(request, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            breaker.failed()
+            raise
+        if res.status_code in RETRY_STATUS_CODES and not is_throttled(res.status_code, res.headers):
+            breaker.failed()
+            discarded.append(res)
+            raise RetryableResponse(res)
+        breaker.succeeded()
+        return res
+
+
+# Connection settings shared by every HTTP client in _lib. Override in the app settings.
+POOL_CONNECTIONS = int(os.environ.get("HttpPoolConnections", 10))  # Hosts kept in a requests pool.
+POOL_MAXSIZE = int(os.environ.get("HttpPoolMaxSize", 32))  # Connections per host, sync clients.
+CONNECTOR_LIMIT = int(os.environ.get("HttpConnectorLimit", 100))  # Connections in total, async clients.
+CONNECTOR_LIMIT_PER_HOST = int(os.environ.get("HttpConnectorLimitPerHost", 32))  # Connections per host, async clients.
+DNS_CACHE_TTL = int(os.environ.get("HttpDnsCacheTtl", 300))
+KEEPALIVE_TIMEOUT = float(os.environ.get("HttpKeepaliveTimeout", 30))
+
 SESSION = None
-TOKENS = defaultdict(lambda: None)
+SESSION_LOCK = threading.Lock()
+SESSIONS = []
+SESSIONS_LOCK = threading.Lock()
+TOKEN_MANAGERS = {}
+TOKEN_MANAGERS_LOCK = threading.Lock()
+
+
+class TokenManager:
+    """
+    Caches one token and refreshes it before it expires. Only one caller refreshes at a time,
+    threads and coroutines that need a token meanwhile wait for that refresh instead of starting their own.
+
+    :param get_token: returns a token, or (token, expires_in_seconds)
+    :param get_token_async: optional coroutine function with the same result, used by token_async
+    :param refresh_margin: seconds before expiry a token is considered expired
+    :param default_ttl: lifetime of tokens returned without expires_in, None for no expiry
+    """
+
+    def __init__(self, get_token, get_token_async=None, refresh_margin=60, default_ttl=None):
+        self.get_token = get_token
+        self.get_token_async = get_token_async
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.current = None
+        self.expires_at = None
+        self.lock = threading.Lock()
+        self.refreshes = {}  # event loop -> future of the refresh in progress on that loop
+
+    def valid(self):
+        if self.current is None:
+            return False
+        return self.expires_at is None or time.monotonic() < self.expires_at - self.refresh_margin
+
+    def store(self, result):
+        expires_in = self.default_ttl
+        if isinstance(result, tuple):
+            result, expires_in = result
+        self.current = result
+        self.expires_at = None if expires_in is None else time.monotonic() + expires_in
+
+    def token(self):
+        if self.valid():
+            return self.current
+        with self.lock:
+            if not self.valid():
+                self.store(self.get_token())
+            return self.current
+
+    async def token_async(self):
+        if self.valid():
+            return self.current
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            refresh = self.refreshes.get(loop)
+            leader = refresh is None
+            if leader:
+                refresh = self.refreshes[loop] = loop.create_future()
+        if not leader:
+            try:
+                return await asyncio.shield(refresh)
+            except asyncio.CancelledError:
+                if not refresh.cancelled():
+                    raise  # This caller was cancelled itself.
+                return await self.token_async()  # The leader was cancelled, refresh again.
+        try:
+            if self.get_token_async is None:
+                # The sync provider would block the event loop, run it on the default executor.
+                await loop.run_in_executor(None, self.token)
+            elif not self.valid():
+                result = await self.get_token_async()
+                with self.lock:
+                    self.store(result)
+            refresh.set_result(self.current)
+            return self.current
+        except Exception as e:
+            refresh.set_exception(e)
+            refresh.exception()  # Marks it retrieved when no one else was waiting.
+            raise
+        finally:
+            # A cancelled leader raises CancelledError, which the except above doesn't see.
+            # Cancelling refresh wakes the waiting followers instead of leaving them blocked on it.
+            if not refresh.done():
+                refresh.cancel()
+            with self.lock:
+                del self.refreshes[loop]
+
+    # Drops the token a request was rejected with. A token that was already replaced is kept,
+    # so concurrent 401s on the same stale token cause a single refresh.
+    def invalidate(self, token):
+        with self.lock:
+            if self.current == token:
+                self.current = None
+
+
+def get_token_manager(token_id, get_token, get_token_async=None) -> TokenManager:
+    with TOKEN_MANAGERS_LOCK:
+        if token_id not in TOKEN_MANAGERS:
+            TOKEN_MANAGERS[token_id] = TokenManager(get_token, get_token_async)
+        return TOKEN_MANAGERS[token_id]
 
 
 def retry_with_token(token_id, get_token, codes=None):
@@ -54,18 +301,17 @@ def retry_with_token(token_id, get_token, codes=None):
     def retry_with_token_decorator(fn):
         @functools.wraps(fn)
         def wrapper(*args, **kwargs):
-            global TOKENS
+            manager = get_token_manager(token_id, get_token)
+            token = manager.token()
             try:
-                if TOKENS[token_id] is None:
-                    TOKENS[token_id] = get_token()
-                res = fn(*args, **kwargs, token=TOKENS[token_id])
+                res = fn(*args, **kwargs, token=token)
                 if isinstance(res, requests.Response) and res.status_code in [401] + codes:
                     res.raise_for_status()
                 return res
             except requests.HTTPError as e:
                 if e.response.status_code in [401] + codes:
-                    TOKENS[token_id] = get_token()
-                    return fn(*args, **kwargs, token=TOKENS[token_id])
+                    manager.invalidate(token)
+                    return fn(*args, **kwargs, token=manager.token())
                 else:
                     raise e
 
@@ -74,25 +320,25 @@ def retry_with_token(token_id, get_token, codes=None):
     return retry_with_token_decorator
 
 
-def retry_with_token_async(token_id, get_token, codes=None):
+# get_token_async is used when given, otherwise get_token is run off the event loop.
+def retry_with_token_async(token_id, get_token, codes=None, get_token_async=None):
     if codes is None:
         codes = []
 
     def retry_with_token_async_decorator(fn):
         @functools.wraps(fn)
         async def wrapper(*args, **kwargs):
-            global TOKENS
+            manager = get_token_manager(token_id, get_token, get_token_async)
+            token = await manager.token_async()
             try:
-                if TOKENS[token_id] is None:
-                    TOKENS[token_id] = get_token()
-                res = await fn(*args, **kwargs, token=TOKENS[token_id])
-                if isinstance(res, aiohttp.ClientResponse) and res.status_code in [401] + codes:
+                res = await fn(*args, **kwargs, token=token)
+                if isinstance(res, aiohttp.ClientResponse) and res.status in [401] + codes:
                     res.raise_for_status()
                 return res
             except aiohttp.ClientResponseError as e:
                 if e.status in [401] + codes:
-                    TOKENS[token_id] = get_token()
-                    return await fn(*args, **kwargs, token=TOKENS[token_id])
+                    manager.invalidate(token)
+                    return await fn(*args, **kwargs, token=await manager.token_async())
                 raise e
 
         return wrapper
@@ -100,19 +346,296 @@ def retry_with_token_async(token_id, get_token, codes=None):
     return retry_with_token_async_decorator
 
 
+def create_session(headers=None, pool_maxsize=None, max_retries=0) -> requests.Session:
+    """
+    requests.Session with TCP keepalive and pools sized for multi-threaded callers.
+    Requests go through the host's circuit breaker and are retried with backoff, see HTTPAdapterWithCircuitBreaker.
+    Every session created here is closed by close_sessions.
+
+    :param headers: default headers sent with every request
+    :param pool_maxsize: connections kept per host, defaults to POOL_MAXSIZE
+    """
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    for prefix in ("https://", "http://"):
+        session.mount(
+            prefix,
+            HTTPAdapterWithCircuitBreaker(
+                pool_connections=POOL_CONNECTIONS,
+                pool_maxsize=pool_maxsize or POOL_MAXSIZE,
+                max_retries=max_retries,
+            ),
+        )
+    with SESSIONS_LOCK:
+        SESSIONS.append(session)
+    return session
+
+
 def get_session():
     global SESSION
     if SESSION is None:
-        SESSION = requests.Session()
-        SESSION.mount("https", HTTPAdapterWithTCPKeepalive(max_retries=1))
+        with SESSION_LOCK:
+            if SESSION is None:
+                SESSION = create_session()
     return SESSION
 
 
-AIO_SESSION = None
+AIO_SESSIONS = {}  # event loop -> aiohttp session
+AIO_USERS = {}  # event loop -> number of open aio_session scopes
+AIO_SESSIONS_LOCK = threading.Lock()
+AIO_CLOSING = set()
 
 
+# One shared aiohttp session per event loop. A session can't be used from another loop,
+# so a new one is created for every loop. Sessions left behind by closed loops are closed then.
 def get_aio_session():
-    global AIO_SESSION
-    if AIO_SESSION is None:
-        AIO_SESSION = aiohttp.ClientSession()  # Supports keepalive by default
-    return AIO_SESSION
+    loop = asyncio.get_running_loop()
+    with AIO_SESSIONS_LOCK:
+        session = AIO_SESSIONS.get(loop)
+        if session is None or session.closed:
+            for old_loop in [old_loop for old_loop in AIO_SESSIONS if old_loop.is_closed()]:
+                discard_aio_session(AIO_SESSIONS.pop(old_loop))
+            connector = aiohttp.TCPConnector(
+                limit=CONNECTOR_LIMIT,
+                limit_per_host=CONNECTOR_LIMIT_PER_HOST,
+                ttl_dns_cache=DNS_CACHE_TTL,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+            )
+            session = AIO_SESSIONS[loop] = aiohttp.ClientSession(connector=connector)
+    return session
+
+
+# Closes a session whose loop is closed. Nothing runs on that loop anymore, so the close runs on the current one.
+def discard_aio_session(session):
+    if session.closed:
+        return
+    task = asyncio.ensure_future(session.close())
+    AIO_CLOSING.add(task)
+    task.add_done_callback(AIO_CLOSING.discard)
+
+
+async def close_aio_session():
+    loop = asyncio.get_running_loop()
+    with AIO_SESSIONS_LOCK:
+        session = AIO_SESSIONS.pop(loop, None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+@contextlib.asynccontextmanager
+async def aio_session():
+    """
+    Async context manager around get_aio_session. The loop's session is closed when the last
+    scope on that loop exits, so callers like asyncio.run(get_all_object_async(...)) don't leave it open.
+    """
+    loop = asyncio.get_running_loop()
+    with AIO_SESSIONS_LOCK:
+        AIO_USERS[loop] = AIO_USERS.get(loop, 0) + 1
+    try:
+        yield get_aio_session()
+    finally:
+        with AIO_SESSIONS_LOCK:
+            AIO_USERS[loop] -= 1
+            last = AIO_USERS[loop] == 0
+            if last:
+                del AIO_USERS[loop]
+        if last:
+            await close_aio_session()
+
+
+@atexit.register
+def close_sessions():
+    global SESSION
+    with SESSIONS_LOCK:
+        sessions = SESSIONS[:]
+        SESSIONS.clear()
+        SESSION = None
+    for session in sessions:
+        session.close()
+    with AIO_SESSIONS_LOCK:
+        aio_sessions = list(AIO_SESSIONS.items())
+        AIO_SESSIONS.clear()
+    for loop, session in aio_sessions:
+        # Only a loop that is neither running nor closed can still run the close.
+        if not session.closed and not loop.is_closed() and not loop.is_running():
+            loop.run_until_complete(session.close())
+
+
+class RequestCoalescer:
+    """
+    Shares one outstanding call among all concurrent callers with the same key (single flight).
+    Callers arriving after the call finished start a new one, nothing is cached.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.requests = 0
+        self.saved = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            self.requests += 1
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+            else:
+                self.saved += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    # Same as do for coroutine functions. Waiters get a deep copy, so they can modify the result.
+    async def do_async(self, key, coro_fn):
+        key = (asyncio.get_running_loop(), key)
+        with self.lock:
+            self.requests += 1
+            task = self.in_flight.get(key)
+            leader = task is None
+            if leader:
+                task = self.in_flight[key] = asyncio.ensure_future(coro_fn())
+                task.add_done_callback(lambda _: self.forget(key))
+            else:
+                self.saved += 1
+        result = await asyncio.shield(task)
+        return result if leader else copy.deepcopy(result)
+
+    def forget(self, key):
+        with self.lock:
+            self.in_flight.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "saved": self.saved, "in_flight": len(self.in_flight)}
+
+
+COALESCER = RequestCoalescer()
+
+
+def request_key(url, headers=None):
+    return ("GET", url, tuple(sorted((headers or {}).items())))
+
+
+# GET that shares its response with concurrent identical GETs on the same session.
+# The response is shared, read it (json(), text) but don't modify it.
+def coalesced_get(session, url, headers=None, **kwargs):
+    key = (id(session),) + request_key(url, headers)
+    return COALESCER.do(key, lambda: session.get(url=url, headers=headers, **kwargs))
+
+
+# GET through the host's circuit breaker, retried with jittered backoff on connection errors and 5xx.
+# Throttled responses raise ClientResponseError right away, see is_throttled.
+async def get_json_async(url, headers=None):
+    breaker = get_breaker(url)
+
+    def giveup(e):
+        if isinstance(e, aiohttp.ClientResponseError):
+            return e.status not in RETRY_STATUS_CODES or is_throttled(e.status, e.headers)
+        return False
+
+    @backoff.on_exception(
+        backoff.expo,
+        (aiohttp.ClientError, asyncio.TimeoutError),
+        max_tries=BACKOFF_MAX_TRIES,
+        max_value=BACKOFF_MAX_VALUE,
+        jitter=backoff.full_jitter,
+        giveup=giveup,
+        on_backoff=log_backoff,
+        logger=None,
+    )
+    async def get_json():
+        breaker.allow()
+        try:
+            async with get_aio_session().get(url, headers=headers) as res:
+                if res.status in RETRY_STATUS_CODES and not is_throttled(res.status, res.headers):
+                    breaker.failed()
+                else:
+                    breaker.succeeded()
+                res.raise_for_status()
+                return await res.json()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            breaker.failed()
+            raise
+
+    return await get_json()
+
+
+# get_json_async shared with concurrent identical requests.
+async def coalesced_get_json_async(url, headers=None):
+    return await COALESCER.do_async(request_key(url, headers), lambda: get_json_async(url, headers))
+
+
+def get_coalescing_stats():
+    return COALESCER.stats()
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit that grows additively while calls succeed and is cut multiplicatively on throttling.
+    A throttled call can also pause every caller for the server's Retry-After.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, decrease_factor=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    self.in_flight += 1
+                    return
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    # About one extra slot per round of successful calls.
+    def succeeded(self):
+        with self.condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def throttled(self, retry_after=None):
+        with self.condition:
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+
+# Seconds from a Retry-After header, which is either a number of seconds or an HTTP date.
+def retry_after_seconds(headers, default=None):
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
@@ -0,0 +1,84 @@
+"""
+object_cache.py
+
+Bounded in-process LRU for REST objects with a TTL per objectType.
+Entries keep their ETag, so an expired entry can be revalidated with If-None-Match instead of refetched.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class ObjectCache:
+    def __init__(self, maxsize=1024, default_ttl=60, ttls=None):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.entries = OrderedDict()  # (objectType, id) -> [value, etag, expires_at]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(objectType, object_id):
+        return (objectType, str(object_id))
+
+    def ttl(self, objectType):
+        return self.ttls.get(objectType, self.default_ttl)
+
+    # Returns (value, etag, fresh), or None when nothing is cached. Values are copies, callers may modify them.
+    def get(self, objectType, object_id):
+        key = self.key(objectType, object_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            value, etag, expires_at = entry
+            fresh = time.monotonic() < expires_at
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return copy.deepcopy(value), etag, fresh
+
+    def put(self, objectType, object_id, value, etag=None):
+        key = self.key(objectType, object_id)
+        entry = [copy.deepcopy(value), etag, time.monotonic() + self.ttl(objectType)]
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    # The server confirmed the cached value is still current (304 Not Modified).
+    def revalidated(self, objectType, object_id):
+        key = self.key(objectType, object_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[2] = time.monotonic() + self.ttl(objectType)
+                self.revalidations += 1
+
+    def invalidate(self, objectType, object_id):
+        with self.lock:
+            if self.entries.pop(self.key(objectType, object_id), None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,261 @@
+"""
+poison_triage.py
+
+Triage of poison queue messages before they are replayed.
+
+A failure history per message content is kept in Table Storage: queue handlers decorated with
+records_failures record why a message failed, and every triage run counts how many runs in a row a
+message has been found in the poison queue. Messages are fingerprinted by a hash of their content and
+that failure reason. Per poison queue, triage
+  - deletes exact duplicates (same fingerprint) within the run,
+  - archives messages that failed permanently (Discard/Fail, unparsable JSON) or too many runs in a row
+    to a dead-letter blob container and deletes them,
+  - replays the rest to the original queue through queue_service.replay_queue.
+History of messages no longer in the poison queue is deleted once it is older than CONSECUTIVE_WINDOW.
+"""
+import os
+import json
+import functools
+import hashlib
+import logging
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from _lib.data_models import Discard, Fail
+from _lib.blob_service import CLAIM_CHECK_KEY, check_out, delete_claim_check, get_blob_service, parse_claim_check
+from _lib.queue_service import get_queue_client, get_queue_service, replay_queue
+from _lib.table_service import get_table_service
+
+FAILURE_TABLE = "poisonfailures"
+DEAD_LETTER_CONTAINER = "poison-dead-letter"
+
+# Runs in a row a message may be found in poison before it is archived instead of replayed.
+MAX_CONSECUTIVE_FAILURES = int(os.environ.get("PoisonMaxConsecutiveFailures", 3))
+# A message not seen in poison for this long starts counting from one again. A bit over the weekly schedule.
+CONSECUTIVE_WINDOW = timedelta(days=10)
+
+# Exceptions that will fail again for the same message, replaying them is pointless.
+PERMANENT_EXCEPTIONS = (Discard, Fail, json.JSONDecodeError)
+
+REPLAY = "replay"
+DUPLICATE = "duplicate"
+DEAD_LETTER = "dead_letter"
+
+CREATED = set()
+
+
+def content_hash(content) -> str:
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content or b"").hexdigest()
+
+
+# Identifies a message by its content and why it failed.
+def fingerprint(content, reason=None) -> str:
+    return hashlib.sha256(f"{content_hash(content)}\n{reason or ''}".encode("utf-8")).hexdigest()
+
+
+def partition_key(queue_name):
+    return re.sub(r"[^A-Za-z0-9\-]", "-", queue_name)
+
+
+def get_failure_table():
+    table_service = get_table_service()
+    if FAILURE_TABLE not in CREATED:
+        table_service.create_table(FAILURE_TABLE, fail_on_exist=False)
+        CREATED.add(FAILURE_TABLE)
+    return table_service
+
+
+def record_failure(queue_name, message, exception):
+    """
+    Records why a message failed, so triage can tell permanent failures from transient ones.
+    Usually called through records_failures.
+    """
+    try:
+        get_failure_table().insert_or_merge_entity(FAILURE_TABLE, {
+            "PartitionKey": partition_key(queue_name),
+            "RowKey": content_hash(message),
+            "reason": f"{type(exception).__name__}: {exception}"[:1024],
+            "permanent": isinstance(exception, PERMANENT_EXCEPTIONS),
+        })
+    except Exception as e:
+        logging.error("Could not record failure for message on queue %s: %s", queue_name, e)
+
+
+def records_failures(queue_name):
+    """
+    Decorator for queue handlers that take the message body as they got it from the queue.
+    Failures are recorded with record_failure and re-raised, so the message still ends up in poison.
+    """
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(message, *args, **kwargs):
+            try:
+                return handler(message, *args, **kwargs)
+            except Exception as e:
+                record_failure(queue_name, message, e)
+                raise
+
+        return wrapper
+
+    return decorator
+
+
+def load_history(queue_name):
+    entities = get_failure_table().query_entities(
+        FAILURE_TABLE, filter=f"PartitionKey eq '{partition_key(queue_name)}'"
+    )
+    return {entity["RowKey"]: entity for entity in entities}
+
+
+HISTORY_FIELDS = ("PartitionKey", "RowKey", "fingerprint", "consecutive", "last_triaged", "reason", "permanent")
+
+
+def save_history(entities):
+    table_service = get_failure_table()
+    entities = [{k: entity[k] for k in HISTORY_FIELDS if k in entity} for entity in entities]
+    for i in range(0, len(entities), 100):  # Table batches take at most 100 entities of one partition.
+        with table_service.batch(FAILURE_TABLE) as batch:
+            for entity in entities[i:i + 100]:
+                batch.insert_or_replace_entity(entity)
+
+
+# History last written longer than CONSECUTIVE_WINDOW ago. Failures recorded by records_failures
+# of messages that were never triaged, because a retry succeeded, only have the Table Storage Timestamp.
+def is_expired(entity, now):
+    last_triaged = entity.get("last_triaged")
+    written = datetime.fromisoformat(last_triaged) if last_triaged else entity.get("Timestamp")
+    return written is not None and now - written > CONSECUTIVE_WINDOW
+
+
+def delete_history(queue_name, keys):
+    table_service = get_failure_table()
+    keys = list(keys)
+    for i in range(0, len(keys), 100):
+        with table_service.batch(FAILURE_TABLE) as batch:
+            for key in keys[i:i + 100]:
+                batch.delete_entity(partition_key(queue_name), key)
+
+
+def is_unparsable(content):
+    if not content or content.lstrip()[:1] not in ("{", "["):
+        return False  # Not meant to be JSON, e.g. a blob path.
+    try:
+        json.loads(content)
+        return False
+    except ValueError:
+        return True
+
+
+# Decides what to do with one message and updates its history entity, which is keyed by content hash.
+def classify(queue_name, message, key, history, now):
+    entity = history.get(key) or {"PartitionKey": partition_key(queue_name), "RowKey": key, "consecutive": 0}
+    last_triaged = entity.get("last_triaged")
+    if last_triaged and now - datetime.fromisoformat(last_triaged) > CONSECUTIVE_WINDOW:
+        entity["consecutive"] = 0
+    entity["consecutive"] = entity.get("consecutive", 0) + 1
+    entity["last_triaged"] = now.isoformat()
+    history[key] = entity
+
+    if is_unparsable(message.content):
+        entity["reason"] = entity.get("reason") or "Unparsable JSON"
+        return DEAD_LETTER, entity["reason"]
+    if entity.get("permanent"):
+        return DEAD_LETTER, entity.get("reason")
+    if entity["consecutive"] >= MAX_CONSECUTIVE_FAILURES:
+        return DEAD_LETTER, f"Failed {entity['consecutive']} runs in a row. Last reason: {entity.get('reason')}"
+    return REPLAY, entity.get("reason")
+
+
+# Archives the message with its original content, claim check pointers are resolved first.
+def dead_letter(queue_name, message, fp, reason):
+    content = message.content
+    claim_check = parse_claim_check(content)
+    if claim_check:
+        try:
+            content = check_out(claim_check)
+        except ResourceNotFoundError:
+            logging.warning("Claim check %s of %s is gone, archiving the pointer", claim_check[CLAIM_CHECK_KEY], queue_name)
+    blob_service = get_blob_service()
+    if DEAD_LETTER_CONTAINER not in CREATED:
+        try:
+            blob_service.create_container(DEAD_LETTER_CONTAINER)
+        except ResourceExistsError:
+            pass
+        CREATED.add(DEAD_LETTER_CONTAINER)
+    blob_service.get_blob_client(DEAD_LETTER_CONTAINER, f"{queue_name}/{fp}.json").upload_blob(
+        json.dumps({
+            "queue": queue_name,
+            "fingerprint": fp,
+            "reason": reason,
+            "dequeue_count": message.dequeue_count,
+            "inserted_on": str(message.inserted_on),
+            "content": content,
+            "claim_check": claim_check[CLAIM_CHECK_KEY] if claim_check else None,
+        }),
+        overwrite=True,
+    )
+
+
+def triage_queue(queue_name, count, **kwargs):
+    """
+    Triages up to count messages of `queue_name`-poison. Receiving, replaying and deleting go through
+    replay_queue, which takes the rate and concurrency kwargs. Returns the number of messages per action.
+    """
+    history = load_history(queue_name)
+    now = datetime.now(timezone.utc)
+    fingerprints = {}  # content hash -> fingerprint, of the messages triaged in this run
+    done = {DUPLICATE: 0, DEAD_LETTER: 0}
+    lock = threading.Lock()
+
+    def count_done(action):
+        with lock:
+            done[action] += 1
+
+    def archive(message, fp, reason):
+        dead_letter(queue_name, message, fp, reason)
+        delete_claim_check(message.content)
+        count_done(DEAD_LETTER)
+
+    # Runs on the receiving thread, so fingerprints and history need no lock.
+    # The fingerprint uses the reason recorded before this run, classify may fill one in for later copies.
+    # A duplicate of a claim check pointer points to the same blob as the copy that is kept, so its blob
+    # is left for that copy: the handler deletes it after a successful replay, archive when it is archived.
+    def triage(message):
+        key = content_hash(message.content)
+        if key in fingerprints:
+            return functools.partial(count_done, DUPLICATE)
+        fp = fingerprints[key] = fingerprint(message.content, (history.get(key) or {}).get("reason"))
+        action, reason = classify(queue_name, message, key, history, now)
+        history[key]["fingerprint"] = fp
+        if action == DEAD_LETTER:
+            return functools.partial(archive, message, fp, reason)
+        return None
+
+    replayed = replay_queue(queue_name, count, triage=triage, **kwargs)
+    save_history(history[key] for key in fingerprints)
+    # Messages not found in this run were replayed successfully or archived, unless the queue had more than count.
+    expired = [key for key, entity in history.items() if key not in fingerprints and is_expired(entity, now)]
+    delete_history(queue_name, expired)
+    report = {"queue": queue_name, REPLAY: replayed["moved"], **done, "failed": replayed["failed"],
+              "expired": len(expired), "seconds": replayed["seconds"]}
+    logging.info("Triaged poison queue for %s: %s", queue_name, report)
+    return report
+
+
+# Triages every poison queue, max_queues of them in parallel.
+def triage_all_poison(max_queues=4, **kwargs) -> list:
+    queues = []
+    for queue in get_queue_service().list_queues(include_metadata=True):
+        if queue.name.endswith("-poison"):
+            count = get_queue_client(queue.name).get_queue_properties().approximate_message_count
+            if count > 0:
+                queues.append((re.sub(r"\-poison$", "", queue.name), count))
+    if not queues:
+        return []
+    with ThreadPoolExecutor(max_workers=max_queues) as executor:
+        return list(executor.map(lambda queue: triage_queue(*queue, **kwargs), queues))
@@ -3,10 +3,12 @@ import logging
 import json
 import time
 import re
-from decimal import Decimal
-from datetime import datetime
-from azure.storage.queue import QueueServiceClient, TextBase64DecodePolicy, TextBase64EncodePolicy
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from azure.storage.queue import QueueClient, QueueServiceClient, TextBase64DecodePolicy, TextBase64EncodePolicy
 from azure.storage.blob import BlobServiceClient
+from _lib.codec import serialize, deserialize, ExtendedEncoder, ExtendedDecoder, DATE_TIME_FORMAT
 
 
 DEFAULT_ACCOUNT_NAME = os.environ["AzureStorageName"]
@@ -43,83 +45,196 @@ def get_queue_service(account=DEFAULT_ACCOUNT_NAME) -> QueueServiceClient:
     return QUEUE_SERVICES[account]
 
 
-def put_queue(queue_name, message, **kwargs):
-    try:
-        queue_client = get_queue_service().get_queue_client(
+QUEUE_CLIENTS = {}
+QUEUE_CLIENTS_LOCK = threading.Lock()
+
+# Storage queue messages are at most 64 KB after base64 encoding, which adds a third.
+# Larger messages are put in blob storage and replaced by a claim check pointer, see blob_service.check_in.
+CLAIM_CHECK_THRESHOLD = int(os.environ.get("QueueClaimCheckThreshold", 45 * 1024))
+# Only queues whose consumers resolve pointers (blob_service.claim_checked) may get them, comma separated.
+# Large messages for other queues fail at send time as before.
+CLAIM_CHECK_QUEUES = {name.strip() for name in os.environ.get("QueueClaimCheckQueues", "").split(",") if name.strip()}
+
+
+# One client per (account, queue), shared by every caller. Messages are base64 encoded.
+def get_queue_client(queue_name, account=DEFAULT_ACCOUNT_NAME) -> QueueClient:
+    key = (account, queue_name)
+    with QUEUE_CLIENTS_LOCK:
+        if key not in QUEUE_CLIENTS:
+            QUEUE_CLIENTS[key] = get_queue_service(account).get_queue_client(
                                             queue_name,
                                             message_encode_policy = TextBase64EncodePolicy(),
                                             message_decode_policy = TextBase64DecodePolicy()
                                             )
-        queue_client.send_message(message)
-    except Exception as e:
-        logging.error("Failed to put message on queue: %s.", queue_name)
-        logging.error(message)
-        logging.error(e)
-
-
-
-def retry(queue, count=1):
-    queue_client = get_queue_service().get_queue_client(
-                                        queue,
-                                        message_encode_policy = TextBase64EncodePolicy(),
-                                        message_decode_policy = TextBase64DecodePolicy()
-                                        )
-    queue_client_poison = get_queue_service().get_queue_client(queue + "-poison",
-                                        message_encode_policy = TextBase64EncodePolicy(),
-                                        message_decode_policy = TextBase64DecodePolicy()
-                                        )
-    count = int(count)
-    while count > 0:
-        messages = queue_client_poison.receive_messages(max_messages=min(32, count), visibility_timeout=30)
-        logging.warning(messages)
-        for message in messages:
-            time.sleep(0.2)
-            queue_client.send_message(message.content)
-            queue_client_poison.delete_message(message)
-        count = count - min(32, count)
-
-
-# json.dumps that supports Decimal and datetime
-def serialize(item):
-    return json.dumps(item, cls=ExtendedEncoder)
+        return QUEUE_CLIENTS[key]
 
 
-# json.loads that supports Decimal and datetime
-def deserialize(string):
-    return json.loads(string, cls=ExtendedDecoder)
+def claim_check_if_large(queue_name, message, account=DEFAULT_ACCOUNT_NAME):
+    if queue_name not in CLAIM_CHECK_QUEUES:
+        return message
+    if isinstance(message, str) and len(message.encode("utf-8")) > CLAIM_CHECK_THRESHOLD:
+        from _lib.blob_service import check_in  # blob_service imports this module.
+        return check_in(queue_name, message, account=account)
+    return message
 
 
-DATE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
-
-
-class ExtendedDecoder(json.JSONDecoder):
-    def __init__(self, *args, **kwargs):
-        json.JSONDecoder.__init__(self, object_hook=self.object_hook, *args, **kwargs)
-
-    def object_hook(self, o):
-        if o.get("_type") == "datetime":
-            return datetime.strptime(o["value"], DATE_TIME_FORMAT)
-        if o.get("_type") == "decimal":
-            return Decimal(o["value"])
-        return o
-
-
-class ExtendedEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, Decimal):
-            return {"_type": "decimal", "value": str(o)}
-        if isinstance(o, datetime):
-            return {"_type": "datetime", "value": o.strftime(DATE_TIME_FORMAT)}
-        return super().default(o)
-
-
-
-def retry_all_msg_in_poison() -> None:
+def put_queue(queue_name, message, **kwargs):
+    try:
+        get_queue_client(queue_name).send_message(claim_check_if_large(queue_name, message))
+    except Exception as e:
+        logging.error("Failed to put message on queue: %s. %s Message: %s", queue_name, e, message)
+
+
+def put_many(queue_name, messages, max_concurrency=16, account=DEFAULT_ACCOUNT_NAME):
+    """
+    Sends many messages to a queue concurrently through the shared queue client.
+    Returns one {"ok", "error"} dict per message, in order. Failures are logged once for the whole call.
+    """
+    queue_client = get_queue_client(queue_name, account)
+
+    def send(message):
+        try:
+            queue_client.send_message(claim_check_if_large(queue_name, message, account))
+            return {"ok": True, "error": None}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        results = list(executor.map(send, messages))
+    failed = [result["error"] for result in results if not result["ok"]]
+    if failed:
+        logging.error("Failed to put %d of %d messages on queue: %s. First error: %s", len(failed), len(results), queue_name, failed[0])
+    return results
+
+
+
+# Messages per second moved back from a poison queue, per queue. 0 for no limit.
+REPLAY_RATE = float(os.environ.get("PoisonReplayRate", 100))
+REPLAY_CONCURRENCY = int(os.environ.get("PoisonReplayConcurrency", 16))
+REPLAY_VISIBILITY_TIMEOUT = int(os.environ.get("PoisonReplayVisibilityTimeout", 120))
+# Messages per receive call, at most 32. Also passed as messages_per_page, otherwise the SDK fetches one message per request.
+MAX_MESSAGES_PER_RECEIVE = 32
+
+
+class RateLimiter:
+    """
+    Spaces calls to acquire evenly at `rate` per second over all threads. rate 0 or None disables it.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+MOVED = "moved"
+HANDLED = "handled"
+FAILED = "failed"
+
+
+def replay_queue(queue, count, rate=REPLAY_RATE, max_concurrency=REPLAY_CONCURRENCY,
+                 visibility_timeout=REPLAY_VISIBILITY_TIMEOUT, triage=None):
+    """
+    Moves up to count messages from `queue`-poison back to `queue`.
+
+    Receiving, sending and deleting are pipelined: the next batch is received while the previous ones
+    are sent by max_concurrency threads, at most `rate` messages per second. Messages that have waited
+    for half their visibility timeout get it extended before they are sent, so they don't reappear mid-run.
+
+    triage, when given, is called with every received message on the receiving thread. It returns None
+    to replay the message, or a function that is called on a sending thread instead of sending it,
+    e.g. to archive it. Either way the message is deleted from poison once that succeeded.
+    Returns {"queue", "moved", "handled", "failed", "seconds", "rate"}.
+    """
+    queue_client = get_queue_client(queue)
+    queue_client_poison = get_queue_client(queue + "-poison")
+    limiter = RateLimiter(rate)
+    # Up to one batch per thread is received ahead of sending, make sure those stay hidden meanwhile.
+    if rate:
+        backlog = (max_concurrency + 1) * MAX_MESSAGES_PER_RECEIVE
+        visibility_timeout = max(visibility_timeout, int(2 * backlog / rate))
+
+    def move(message, received_at, handle):
+        if handle is None:
+            limiter.acquire()
+        try:
+            if time.monotonic() - received_at > visibility_timeout / 2:
+                updated = queue_client_poison.update_message(message, visibility_timeout=visibility_timeout)
+                message.pop_receipt = updated.pop_receipt
+            if handle is None:
+                queue_client.send_message(message.content)
+            else:
+                handle()
+            queue_client_poison.delete_message(message.id, pop_receipt=message.pop_receipt)
+            return MOVED if handle is None else HANDLED
+        except Exception as e:
+            logging.warning("Failed to replay message %s to %s: %s", message.id, queue, e)
+            return FAILED
+
+    results = {MOVED: 0, HANDLED: 0, FAILED: 0}
+    remaining = int(count)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        in_flight = deque()
+        while remaining > 0:
+            size = min(MAX_MESSAGES_PER_RECEIVE, remaining)
+            batch = list(queue_client_poison.receive_messages(
+                max_messages=size, messages_per_page=size, visibility_timeout=visibility_timeout
+            ))
+            if not batch:
+                break
+            received_at = time.monotonic()
+            remaining -= len(batch)
+            for message in batch:
+                handle = triage(message) if triage else None
+                in_flight.append(executor.submit(move, message, received_at, handle))
+            while len(in_flight) > max_concurrency * MAX_MESSAGES_PER_RECEIVE:
+                results[in_flight.popleft().result()] += 1
+        for future in in_flight:
+            results[future.result()] += 1
+
+    seconds = time.monotonic() - start
+    moved = results[MOVED]
+    report = {"queue": queue, **results, "seconds": round(seconds, 2),
+              "rate": round(moved / seconds, 1) if seconds else 0.0}
+    logging.info("Replayed %s messages to %s in %ss (%s msg/s), %s handled otherwise, %s failed",
+                 moved, queue, report["seconds"], report["rate"], results[HANDLED], results[FAILED])
+    return report
+
+
+def retry(queue, count=1, **kwargs):
+    return replay_queue(queue, count, **kwargs)
+
+
+
+# Replays every poison queue, max_queues of them in parallel. Returns one replay report per queue.
+def retry_all_msg_in_poison(max_queues=4, **kwargs) -> list:
+    queues = []
     for queue in get_queue_service().list_queues(include_metadata=True):
         if queue.name.endswith("-poison"):
             to_queue_name = re.sub(r"\-poison$", "", queue.name)
-            queue_client = get_queue_service().get_queue_client(queue)
-            count = queue_client.get_queue_properties().approximate_message_count
+            count = get_queue_client(queue.name).get_queue_properties().approximate_message_count
             if count > 0:
                 logging.info("preforming retry for %s on queue %s", count, queue.name)
-                retry(to_queue_name, count)
+                queues.append((to_queue_name, count))
+    if not queues:
+        return []
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_queues) as executor:
+        reports = list(executor.map(lambda queue: replay_queue(*queue, **kwargs), queues))
+    seconds = time.monotonic() - start
+    moved = sum(report["moved"] for report in reports)
+    logging.info("Replayed %s messages from %s poison queues in %.1fs (%.1f msg/s)",
+                 moved, len(reports), seconds, moved / seconds if seconds else 0.0)
+    return reports
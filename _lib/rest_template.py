@@ -1,9 +1,14 @@
 import requests
 import os
+import asyncio
 import functools
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlsplit
 from _lib.cosmos import datalake
+from _lib.http import create_session, aio_session, coalesced_get, coalesced_get_json_async, get_json_async, AIMDLimiter, retry_after_seconds
+from _lib.object_cache import ObjectCache
 from requests.exceptions import HTTPError
 from _lib.doc_type import (
             DOC_TYPE_TEST_OBJECT,
@@ -12,11 +17,20 @@ from _lib.doc_type import (
 BASE_URL = os.environ["ApiUrl"] # https://oneagencysweden.lime-crm.com
 BASE_PATH = os.environ["ApiBasePath"]
 API_KEY = os.environ["ApiKey"]
+# Share one request among concurrent identical GETs, see http.get_coalescing_stats.
+COALESCE_GETS = os.environ.get("CoalesceGets", "false").lower() == "true"
 
 
 BASE_SESSION = None
 BASE_TOKEN = None
 
+# Seconds a fetched object is served from cache before it is revalidated, per objectType.
+OBJECT_CACHE_TTL = {
+    "LimeCoWorker": 300,
+    "LimeCompany": 300,
+}
+OBJECT_CACHE = ObjectCache(maxsize=2048, default_ttl=60, ttls=OBJECT_CACHE_TTL)
+
 
 class FailedAuth(Exception):
     pass
@@ -47,11 +61,12 @@ def get_session():
     return BASE_SESSION
 
 
+def get_headers():
+    return {"x-api-key": API_KEY, "Content-Type" : "application/json"}
+
+
 def create_authenticated_session():
-    token = API_KEY
-    sesh = requests.Session()
-    sesh.headers.update({"x-api-key": token, "Content-Type" : "application/json"})
-    return sesh
+    return create_session(headers=get_headers())
 
 
 def retry_with_token(func):
@@ -127,50 +142,173 @@ def clean_standard_attributes(item):
 
 
 def clean_test_object(consultant):
-    if "key" in consultant["resourcestatus"]:
+    if isinstance(consultant.get("resourcestatus"), dict) and "key" in consultant["resourcestatus"]:
         resourcestatus = consultant["resourcestatus"]["key"]
         consultant.pop("resourcestatus", None)
         consultant["resourcestatus"] = resourcestatus
 
 
+# Example from Lime. Cleaning applied per objectType after clean_standard_attributes.
+OBJECT_CLEANERS = {
+    "LimeConsultant": clean_test_object,
+}
+
+
+def clean_object(objects=None, objectType=None):
+    cleaner = OBJECT_CLEANERS.get(objectType)
+    for item in objects:
+        clean_standard_attributes(item)
+        if cleaner:
+            cleaner(item)
+
+
 def get_all_object(object_id=None, objectType=None):
-    all_objects = []
+    return list(iter_all_objects(objectType))
+
+
+def session_get(query_url, headers=None):
+    if COALESCE_GETS:
+        return coalesced_get(get_session(), query_url, headers)
+    return get_session().get(url=query_url, headers=headers)
+
+
+def get_page(query_url):
+    res = session_get(query_url)
+    res.raise_for_status()
+    return res.json()
+
+
+# Yields the cleaned objects of every page, one page at a time.
+# With prefetch the next page is downloaded while the current one is being consumed.
+# params are added to the query of the first page, Lime carries them over to the next links.
+def iter_pages(objectType=None, page_size=40, prefetch=True, params=None):
     path = get_path(objectType)
-    if path:
-        path = path + "?_limit=40"
-        query_url = BASE_URL + BASE_PATH + path
+    if not path:
+        return
+    query_url = BASE_URL + BASE_PATH + path + "?" + urlencode({"_limit": page_size, **(params or {})})
+    if not prefetch:
         while query_url:
-            res = get_session().get(url=query_url)
-            res.raise_for_status()
-            response = res.json()
-            objects = response["_embedded"]["limeobjects"] # From Lime.
-            clean_object(objects, objectType)
-            all_objects += objects
-            query_url = ""
-            if "next" in response["_links"]:
-                query_url = response["_links"]["next"]["href"]
+            response = get_page(query_url)
+            query_url = next_link(response)
+            yield page_objects(response, objectType)
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(get_page, query_url)
+        while next_page:
+            response = next_page.result()
+            query_url = next_link(response)
+            next_page = executor.submit(get_page, query_url) if query_url else None
+            yield page_objects(response, objectType)
+
+
+# Streaming variant of get_all_object, memory stays at about two pages regardless of the number of objects.
+def iter_all_objects(objectType=None, page_size=40, prefetch=True, params=None):
+    for objects in iter_pages(objectType, page_size, prefetch, params):
+        yield from objects
+
+
+
+def page_url(path, page_size, offset):
+    return BASE_URL + BASE_PATH + path + f"?_limit={page_size}&_offset={offset}"
+
+
+async def get_page_async(query_url):
+    if COALESCE_GETS:
+        return await coalesced_get_json_async(query_url, get_headers())
+    return await get_json_async(query_url, get_headers())
+
+
+def page_objects(response, objectType):
+    objects = response["_embedded"]["limeobjects"] # From Lime.
+    clean_object(objects, objectType)
+    return objects
+
+
+def next_link(response):
+    if "next" in response["_links"]:
+        return response["_links"]["next"]["href"]
+    return None
+
+
+# Same result as get_all_object, but pages are fetched concurrently.
+# When the next links use offsets, up to `concurrency` pages are requested at a time and kept in order.
+# Otherwise the next links are followed one by one.
+# The aiohttp session is closed when done, unless another get_all_object_async on the same loop still uses it.
+async def get_all_object_async(objectType=None, page_size=40, concurrency=8):
+    path = get_path(objectType)
+    if not path:
+        return []
+    async with aio_session():
+        return await get_all_pages_async(path, objectType, page_size, concurrency)
+
+
+async def get_all_pages_async(path, objectType, page_size, concurrency):
+    response = await get_page_async(page_url(path, page_size, 0))
+    all_objects = page_objects(response, objectType)
+    next_url = next_link(response)
+    if next_url and all_objects and "_offset" in parse_qs(urlsplit(next_url).query):
+        step = len(all_objects)  # The API may cap _limit below page_size.
+        offset = step
+        while next_url:
+            offsets = range(offset, offset + step * concurrency, step)
+            responses = await asyncio.gather(*[get_page_async(page_url(path, step, o)) for o in offsets])
+            for response in responses:
+                objects = page_objects(response, objectType)
+                all_objects += objects
+                next_url = next_link(response) if objects else None
+                if not next_url:
+                    break
+            offset += step * concurrency
+        return all_objects
+
+    while next_url:
+        response = await get_page_async(next_url)
+        all_objects += page_objects(response, objectType)
+        next_url = next_link(response)
     return all_objects
 
 
 
+# Read through OBJECT_CACHE. Expired entries are revalidated with their ETag when Lime sent one.
 def get_specicic_object(object_id=None, objectType=None):
     path = get_path(objectType)
     if path:
+        cached = OBJECT_CACHE.get(objectType, object_id)
+        if cached and cached[2]:
+            return cached[0]
+        headers = {"If-None-Match": cached[1]} if cached and cached[1] else {}
         try:
             query_url = BASE_URL + BASE_PATH + path + str(object_id) + "/"
-            res = get_session().get(url=query_url)
+            res = session_get(query_url, headers)
+            if res.status_code == 304 and cached:
+                OBJECT_CACHE.revalidated(objectType, object_id)
+                return cached[0]
             res.raise_for_status()
             response = res.json()
             clean_standard_attributes(response)
+            OBJECT_CACHE.put(objectType, object_id, response, res.headers.get("ETag"))
             return response
         except HTTPError as ex:
             if ex.response.status_code == 404:
+                OBJECT_CACHE.invalidate(objectType, object_id)
                 return None
             else:
                 raise ex         
     return None
 
 
+def get_object_cache_stats():
+    return OBJECT_CACHE.stats()
+
+
+def invalidate_cached_object(object=None, objectType=None):
+    if isinstance(object, dict):
+        for id_key in ("id", "_id"):
+            if object.get(id_key) is not None:
+                OBJECT_CACHE.invalidate(objectType, object[id_key])
+
+
 
 
 def get_specific_connected_objects(object_id=None, objectType=None, connected_object=None):
@@ -179,7 +317,7 @@ def get_specific_connected_objects(object_id=None, objectType=None, connected_ob
     if path:
         try:
             query_url = BASE_URL + BASE_PATH + path + str(object_id) + "/" + object_path
-            res = get_session().get(url=query_url)
+            res = session_get(query_url)
             res.raise_for_status()
             response = res.json()
             # clean_standard_attributes(response)
@@ -193,6 +331,21 @@ def get_specific_connected_objects(object_id=None, objectType=None, connected_ob
 
 
 
+# Fetches the connected objects of many parents concurrently through the shared session.
+# Takes (object_id, objectType, connected_object) triples and returns {(object_id, objectType, connected_object): children},
+# children being None when the parent isn't found, as in get_specific_connected_objects.
+# The full triple is the key, so one parent can be enriched with several connected types and
+# ids of different objectTypes don't collide. Duplicate triples are fetched once.
+def get_connected_objects_batch(triples, max_concurrency=8):
+    unique = list(dict.fromkeys(tuple(triple) for triple in triples))
+    if not unique:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(unique))) as executor:
+        children = executor.map(lambda triple: get_specific_connected_objects(*triple), unique)
+        return dict(zip(unique, children))
+
+
+
 def create_object(object=None, objectType=None):
     path = get_path(objectType)
     if path:
@@ -203,7 +356,9 @@ def create_object(object=None, objectType=None):
             res = get_session().post(url=query_url, json=object)
             res.raise_for_status()
             logging.info(res.content)
-            return json.loads(res.text)
+            created = json.loads(res.text)
+            invalidate_cached_object(created, objectType)
+            return created
         except HTTPError as error:
             logging.warning("Error code= %s", error)
             logging.warning("Error response= %s", error.response.text)
@@ -220,6 +375,7 @@ def delete_object(object=None, objectType=None):
         logging.info("Delete %s with %s", objectType, object)
 
         try:        
+            invalidate_cached_object(object, objectType)
             res = get_session().delete(url=query_url, json=object)
             res.raise_for_status()
             logging.info(res.content)
@@ -239,9 +395,11 @@ def update_specific_object(object_id=None, objectType=None, object=None):
     if path:
         logging.info("object_id=%s, objectType=%s, update_json=%s",object_id, objectType, json.dumps(object))
         query_url = BASE_URL + BASE_PATH + path + str(object_id) + "/"
+        OBJECT_CACHE.invalidate(objectType, object_id)
         try:
             res = get_session().put(url=query_url,json=object)
             res.raise_for_status()
+            OBJECT_CACHE.invalidate(objectType, object_id) # Again, a concurrent read may have cached the old version.
             logging.info(res.content)
         except HTTPError as error:
             logging.warning("Error code= %s", error)
@@ -249,3 +407,70 @@ def update_specific_object(object_id=None, objectType=None, object=None):
             logging.warning("Error request= %s", error.request.body)
             raise error
 
+
+
+THROTTLE_CODES = [429, 503]
+
+
+# Sends one write, retrying on throttling. Returns a per-item result instead of raising.
+def send_throttled(limiter, send, max_attempts):
+    res = None
+    for attempt in range(1, max_attempts + 1):
+        limiter.acquire()
+        try:
+            res = send()
+        except requests.RequestException as error:
+            return {"ok": False, "status": None, "result": None, "error": str(error)}
+        finally:
+            limiter.release()
+        if res.status_code not in THROTTLE_CODES:
+            break
+        limiter.throttled(retry_after_seconds(res.headers, default=attempt))
+    if res.status_code in THROTTLE_CODES or res.status_code >= 400:
+        return {"ok": False, "status": res.status_code, "result": None, "error": res.text}
+    limiter.succeeded()
+    try:
+        result = json.loads(res.text) if res.text else None
+    except ValueError:
+        result = None
+    return {"ok": True, "status": res.status_code, "result": result, "error": None}
+
+
+def bulk_send(sends, max_concurrency, max_attempts, description):
+    limiter = AIMDLimiter(initial=min(4, max_concurrency), maximum=max_concurrency)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        results = list(executor.map(lambda send: send_throttled(limiter, send, max_attempts), sends))
+    failed = sum(1 for result in results if not result["ok"])
+    logging.info("%s: %d succeeded, %d failed", description, len(results) - failed, failed)
+    return results
+
+
+# Creates many objects with bounded concurrency. Honors Retry-After on 429/503 and adapts the number of
+# concurrent writes (AIMD). Returns one {"ok", "status", "result", "error"} dict per object, in order.
+def bulk_create_objects(objects, objectType=None, max_concurrency=16, max_attempts=5):
+    path = get_path(objectType)
+    if not path:
+        return []
+    query_url = BASE_URL + BASE_PATH + path
+    sends = [functools.partial(get_session().post, url=query_url, json=object) for object in objects]
+    results = bulk_send(sends, max_concurrency, max_attempts, f"Bulk create {objectType}")
+    for result in results:
+        invalidate_cached_object(result["result"], objectType)
+    return results
+
+
+# Same as bulk_create_objects for updates. updates is a list of (object_id, object).
+def bulk_update_objects(updates, objectType=None, max_concurrency=16, max_attempts=5):
+    path = get_path(objectType)
+    if not path:
+        return []
+    sends = []
+    for object_id, object in updates:
+        OBJECT_CACHE.invalidate(objectType, object_id)
+        query_url = BASE_URL + BASE_PATH + path + str(object_id) + "/"
+        sends.append(functools.partial(get_session().put, url=query_url, json=object))
+    results = bulk_send(sends, max_concurrency, max_attempts, f"Bulk update {objectType}")
+    for object_id, _ in updates:
+        OBJECT_CACHE.invalidate(objectType, object_id)
+    return results
+
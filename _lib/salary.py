@@ -1,6 +1,16 @@
+import functools
 import logging
+import operator
 from decimal import Decimal
 
+try:
+    import numpy as np
+except ImportError:  # Optional, cost_prices falls back to exact Decimal arithmetic without it.
+    np = None
+
+# Float results this close to a rounding tie are recalculated with Decimal to match the scalar path.
+ROUNDING_TIE_TOLERANCE = 1e-6
+
 
 class AgeGroup:
     ONE = "25-27"
@@ -9,15 +19,82 @@ class AgeGroup:
     FOUR = "50-65"
     INELIGEBLE_FOR_PENSION = "0-24,66+"
 
+    RANGES = {
+        range(25, 27 + 1): ONE,
+        range(28, 37 + 1): TWO,
+        range(38, 49 + 1): THREE,
+        range(50, 65 + 1): FOUR,
+    }
+
     @classmethod
     def get(self, age: int) -> str:
-        groups = {
-            range(25, 27 + 1): AgeGroup.ONE,
-            range(28, 37 + 1): AgeGroup.TWO,
-            range(38, 49 + 1): AgeGroup.THREE,
-            range(50, 65 + 1): AgeGroup.FOUR,
-        }
-        return next((v for k, v in groups.items() if age in k), AgeGroup.INELIGEBLE_FOR_PENSION)
+        return PENSION_RATES_BY_AGE[age_index(age)][0]
+
+
+PENSION_PERCENTAGES_GROUP_ONE = {
+    AgeGroup.ONE: Decimal("0.045"),  # 0.0164
+    AgeGroup.TWO: Decimal("0.045"),   # 0.045
+    AgeGroup.THREE: Decimal("0.045"),  # 0.07
+    AgeGroup.FOUR: Decimal("0.045"),   # 0.07
+    AgeGroup.INELIGEBLE_FOR_PENSION: Decimal("0"),
+}
+
+PENSION_PERCENTAGES_GROUP_TWO = {
+    AgeGroup.ONE: Decimal("0.3"),  # 0.0164
+    AgeGroup.TWO: Decimal("0.3"),     # 0.3
+    AgeGroup.THREE: Decimal("0.3"),  # 0.26
+    AgeGroup.FOUR: Decimal("0.3"),   # 0.31
+    AgeGroup.INELIGEBLE_FOR_PENSION: Decimal("0"),
+}
+
+PENSION_PERCENTAGES_GROUP_THREE = {
+    AgeGroup.ONE: Decimal("0.3"),  # 0.0164
+    AgeGroup.TWO: Decimal("0.3"),     # 0.3
+    AgeGroup.THREE: Decimal("0.3"),  # 0.17
+    AgeGroup.FOUR: Decimal("0.3"),   # 0.25
+    AgeGroup.INELIGEBLE_FOR_PENSION: Decimal("0"),
+}
+
+
+def pension_rates_for_group(age_group: str):
+    return (
+        age_group,
+        PENSION_PERCENTAGES_GROUP_ONE[age_group],
+        PENSION_PERCENTAGES_GROUP_TWO[age_group],
+        PENSION_PERCENTAGES_GROUP_THREE[age_group],
+    )
+
+
+# (age group, group one rate, group two rate, group three rate) indexed by age.
+# The last entry is used for every age outside the table.
+PENSION_RATES_BY_AGE = tuple(
+    pension_rates_for_group(next((v for k, v in AgeGroup.RANGES.items() if age in k), AgeGroup.INELIGEBLE_FOR_PENSION))
+    for age in range(max(k.stop for k in AgeGroup.RANGES) + 1)
+)
+
+
+def age_index(age) -> int:
+    """
+    Position of age in PENSION_RATES_BY_AGE. Ages that aren't whole numbers in the table get the last entry.
+    """
+    try:
+        index = operator.index(age)
+    except TypeError:
+        # Floats and Decimals holding a whole number count as that age, like `age in range(...)` does.
+        # None, strings, NaN and infinity are not in any range, so they get the last entry too.
+        try:
+            if age != int(age):
+                return -1
+            index = int(age)
+        except (TypeError, ValueError, OverflowError):
+            return -1
+    if 0 <= index < len(PENSION_RATES_BY_AGE):
+        return index
+    return -1
+
+
+def pension_rates(age: int):
+    return PENSION_RATES_BY_AGE[age_index(age)]
 
 
 class SalaryGroups:
@@ -26,36 +103,32 @@ class SalaryGroups:
         self.amount_group_two = income_base_amount * Decimal("20")
         self.amount_group_three = income_base_amount * Decimal("30")
 
+    # Shared instance per income base amount, the amounts never change once calculated.
+    @classmethod
+    @functools.lru_cache(maxsize=32)
+    def get(cls, income_base_amount: int) -> "SalaryGroups":
+        return cls(income_base_amount)
+
     @classmethod
     def get_pension_percentage_group_one(cls, age_group: str) -> Decimal:
-        return {
-            AgeGroup.ONE: Decimal("0.045"),  # 0.0164
-            AgeGroup.TWO: Decimal("0.045"),   # 0.045
-            AgeGroup.THREE: Decimal("0.045"),  # 0.07
-            AgeGroup.FOUR: Decimal("0.045"),   # 0.07
-            AgeGroup.INELIGEBLE_FOR_PENSION: Decimal("0"),
-        }[age_group]
+        return PENSION_PERCENTAGES_GROUP_ONE[age_group]
 
     def yearly_pension_cost_group_one(self, yearly_salary: int, age: str) -> Decimal:
-        age_group = AgeGroup.get(age)
-        percentage = self.get_pension_percentage_group_one(age_group)
+        return self.pension_cost_group_one(yearly_salary, pension_rates(age)[1])
+
+    def pension_cost_group_one(self, yearly_salary: int, percentage: Decimal) -> Decimal:
         if yearly_salary > self.amount_group_one:
             return self.amount_group_one * percentage
         return yearly_salary * percentage
 
     @classmethod
     def get_pension_percentage_group_two(cls, age_group: str) -> Decimal:
-        return {
-            AgeGroup.ONE: Decimal("0.3"),  # 0.0164
-            AgeGroup.TWO: Decimal("0.3"),     # 0.3
-            AgeGroup.THREE: Decimal("0.3"),  # 0.26
-            AgeGroup.FOUR: Decimal("0.3"),   # 0.31
-            AgeGroup.INELIGEBLE_FOR_PENSION: Decimal("0"),
-        }[age_group]
+        return PENSION_PERCENTAGES_GROUP_TWO[age_group]
 
     def yearly_pension_cost_group_two(self, yearly_salary: int, age: int) -> Decimal:
-        age_group = AgeGroup.get(age)
-        percentage = self.get_pension_percentage_group_two(age_group)
+        return self.pension_cost_group_two(yearly_salary, pension_rates(age)[2])
+
+    def pension_cost_group_two(self, yearly_salary: int, percentage: Decimal) -> Decimal:
         if yearly_salary > self.amount_group_two:
             return (self.amount_group_two - self.amount_group_one) * percentage
         if yearly_salary <= self.amount_group_one:
@@ -64,17 +137,12 @@ class SalaryGroups:
 
     @classmethod
     def get_pension_percentage_group_three(cls, age_group: str) -> Decimal:
-        return {
-            AgeGroup.ONE: Decimal("0.3"),  # 0.0164
-            AgeGroup.TWO: Decimal("0.3"),     # 0.3
-            AgeGroup.THREE: Decimal("0.3"),  # 0.17
-            AgeGroup.FOUR: Decimal("0.3"),   # 0.25
-            AgeGroup.INELIGEBLE_FOR_PENSION: Decimal("0"),
-        }[age_group]
+        return PENSION_PERCENTAGES_GROUP_THREE[age_group]
 
     def yearly_pension_cost_group_three(self, yearly_salary: int, age: int) -> Decimal:
-        age_group = AgeGroup.get(age)
-        percentage = self.get_pension_percentage_group_three(age_group)
+        return self.pension_cost_group_three(yearly_salary, pension_rates(age)[3])
+
+    def pension_cost_group_three(self, yearly_salary: int, percentage: Decimal) -> Decimal:
         if yearly_salary > self.amount_group_two:
             return (yearly_salary - self.amount_group_two) * percentage
         return 0
@@ -87,6 +155,60 @@ class CostPriceCalculator:
         )
         return calc_cost_price + self.employee_hourly_cost()
 
+    def cost_prices(self, monthly_salaries, ages, income_base_amount: int, exact: bool = False):
+        """
+        Cost price for a whole payroll in one call. Gives the same result as cost_price for every row.
+
+        Uses NumPy when it is installed and returns an int64 array. With exact=True, or without NumPy,
+        every row is calculated with Decimal and a list of ints is returned.
+
+        :param monthly_salaries: sequence or array of monthly salaries
+        :param ages: sequence or array of ages, same length as monthly_salaries
+        :param income_base_amount: income base amount used for all rows
+        """
+        if len(monthly_salaries) != len(ages):
+            raise ValueError("monthly_salaries and ages must have the same length")
+        if exact or np is None:
+            model = CostModel(income_base_amount, self)
+            return [model.cost_price(m, age) for m, age in zip(monthly_salaries, ages)]
+
+        monthly_salaries = np.asarray(monthly_salaries, dtype=np.float64)
+        # Kept as Python objects, ages may be None, strings or Decimals that age_index handles like cost_price does.
+        ages = np.asarray(ages, dtype=object)
+        if monthly_salaries.shape != ages.shape:
+            raise ValueError("monthly_salaries and ages must have the same shape")
+
+        flat_ages = ages.reshape(-1)
+        indices = np.fromiter((age_index(age) for age in flat_ages), dtype=np.intp, count=flat_ages.size)
+        rates = np.array([rates[1:] for rates in PENSION_RATES_BY_AGE], dtype=np.float64)
+        rates = rates[indices].reshape(ages.shape + (3,))
+
+        salary_groups = SalaryGroups.get(income_base_amount)
+        amount_group_one = float(salary_groups.amount_group_one)
+        amount_group_two = float(salary_groups.amount_group_two)
+
+        yearly_salary = monthly_salaries * float(self.yearly_salary(1))
+        pension_cost = (
+            np.minimum(yearly_salary, amount_group_one) * rates[..., 0]
+            + np.clip(yearly_salary - amount_group_one, 0, amount_group_two - amount_group_one) * rates[..., 1]
+            + np.maximum(yearly_salary - amount_group_two, 0) * rates[..., 2]
+        )
+        yearly_cost = yearly_salary * (1 + float(self._employeer_fee_factor())) + pension_cost * (
+            1 + float(self._special_salary_tax_factor())
+        )
+        tens = yearly_cost / self.yearly_working_hours() / 10
+        cost_prices = np.round(tens).astype(np.int64) * 10
+
+        # Round half to even on a float that lands next to .5 may go the other way than Decimal would.
+        ties = np.flatnonzero(np.abs(tens - np.floor(tens) - 0.5) < ROUNDING_TIE_TOLERANCE)
+        flat_cost_prices = cost_prices.reshape(-1)
+        flat_salaries = monthly_salaries.reshape(-1)
+        for i in ties:
+            flat_cost_prices[i] = self.cost_price_monthly_salary(
+                Decimal(repr(flat_salaries[i].item())), flat_ages[i], income_base_amount
+            )
+        return cost_prices + self.employee_hourly_cost()
+
     def cost_price_monthly_salary(
         self, monthly_salary: int, age: int, income_base_amount: int
     ) -> int:
@@ -113,10 +235,11 @@ class CostPriceCalculator:
         return yearly_salary * (1 + self._employeer_fee_factor())
 
     def yearly_pension_cost(self, yearly_salary: int, age: int, income_base_amount: int) -> Decimal:
-        salary_groups = SalaryGroups(income_base_amount)
-        group_one = salary_groups.yearly_pension_cost_group_one(yearly_salary, age)
-        group_two = salary_groups.yearly_pension_cost_group_two(yearly_salary, age)
-        group_three = salary_groups.yearly_pension_cost_group_three(yearly_salary, age)
+        salary_groups = SalaryGroups.get(income_base_amount)
+        _, rate_one, rate_two, rate_three = pension_rates(age)
+        group_one = salary_groups.pension_cost_group_one(yearly_salary, rate_one)
+        group_two = salary_groups.pension_cost_group_two(yearly_salary, rate_two)
+        group_three = salary_groups.pension_cost_group_three(yearly_salary, rate_three)
         return group_one + group_two + group_three
 
     def _employeer_fee_factor(self) -> Decimal:
@@ -131,3 +254,83 @@ class CostPriceCalculator:
     def employee_hourly_cost(self) -> int:
         return 0
 
+
+class CostModel:
+    """
+    CostPriceCalculator compiled for one income base amount.
+
+    Yearly cost is linear in yearly salary between the pension breakpoints at 7.5 and 20 times the income
+    base amount, so each age group gets three (slope, intercept) segments. An evaluation is one segment
+    lookup and a multiply-add, with the same Decimal result as the calculator. The inverse gives the monthly
+    salary for a target hourly cost.
+    """
+
+    def __init__(self, income_base_amount: int, calculator: CostPriceCalculator = None) -> None:
+        calculator = calculator or CostPriceCalculator()
+        salary_groups = SalaryGroups.get(income_base_amount)
+        self.amount_group_one = salary_groups.amount_group_one
+        self.amount_group_two = salary_groups.amount_group_two
+        self.months = calculator.yearly_salary(1)
+        self.hours = calculator.yearly_working_hours()
+        self.employee_hourly_cost = calculator.employee_hourly_cost()
+        self.fee_factor = 1 + calculator._employeer_fee_factor()
+        self.tax_factor = 1 + calculator._special_salary_tax_factor()
+        self.segments = {rates[1:]: self._segments(*rates[1:]) for rates in PENSION_RATES_BY_AGE}
+
+    @classmethod
+    @functools.lru_cache(maxsize=32)
+    def get(cls, income_base_amount: int) -> "CostModel":
+        return cls(income_base_amount)
+
+    def _segments(self, rate_one: Decimal, rate_two: Decimal, rate_three: Decimal):
+        one, two = self.amount_group_one, self.amount_group_two
+        return (
+            (self.fee_factor + self.tax_factor * rate_one, 0),
+            (self.fee_factor + self.tax_factor * rate_two, self.tax_factor * (one * rate_one - one * rate_two)),
+            (
+                self.fee_factor + self.tax_factor * rate_three,
+                self.tax_factor * (one * rate_one + (two - one) * rate_two - two * rate_three),
+            ),
+        )
+
+    def _segment(self, segments, yearly_salary):
+        if yearly_salary <= self.amount_group_one:
+            return segments[0]
+        if yearly_salary <= self.amount_group_two:
+            return segments[1]
+        return segments[2]
+
+    def yearly_cost(self, monthly_salary: int, age: int) -> Decimal:
+        yearly_salary = monthly_salary * self.months
+        slope, intercept = self._segment(self.segments[pension_rates(age)[1:]], yearly_salary)
+        return yearly_salary * slope + intercept
+
+    def hourly_cost(self, monthly_salary: int, age: int) -> Decimal:
+        return self.yearly_cost(monthly_salary, age) / self.hours
+
+    def cost_price(self, monthly_salary: int, age: int) -> int:
+        return int(round(self.hourly_cost(monthly_salary, age), -1)) + self.employee_hourly_cost
+
+    def monthly_salary_for(self, hourly_cost, age: int) -> Decimal:
+        """
+        Monthly salary whose unrounded hourly cost is exactly hourly_cost, employee hourly cost included.
+        """
+        segments = self.segments[pension_rates(age)[1:]]
+        yearly_cost = (Decimal(hourly_cost) - self.employee_hourly_cost) * self.hours
+        for amount, (slope, intercept) in zip((self.amount_group_one, self.amount_group_two), segments):
+            if yearly_cost <= amount * slope + intercept:
+                break
+        else:
+            slope, intercept = segments[2]
+        return (yearly_cost - intercept) / slope / self.months
+
+    def max_monthly_salary(self, cost_price: int, age: int) -> int:
+        """
+        Highest whole monthly salary whose cost_price is at most the given cost price.
+        """
+        monthly_salary = int(self.monthly_salary_for(cost_price + 5, age))
+        while self.cost_price(monthly_salary, age) > cost_price:
+            monthly_salary -= 1
+        while self.cost_price(monthly_salary + 1, age) <= cost_price:
+            monthly_salary += 1
+        return monthly_salary
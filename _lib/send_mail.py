@@ -6,7 +6,7 @@ import json
 import smtplib
 from email.mime.text import MIMEText
 from sendgrid import SendGridAPIClient
-from _lib.queue_service import put_queue
+from _lib.queue_service import put_queue, put_many
 
 def from_plain_text(plain_text):
     rows = plain_text.split("\n")
@@ -76,6 +76,12 @@ def SendMail(mail):
     logging.info("Mail was pushed to queue")
 
 
+def SendMails(mails):
+    results = put_many("emails", [json.dumps(mail) for mail in mails])
+    logging.info("Pushed %d of %d mails to queue", sum(1 for result in results if result["ok"]), len(mails))
+    return results
+
+
 
 def send_email_with_sendgrid(msg: str) -> None:
     logging.info(msg)
@@ -1,11 +1,30 @@
 import operator
 import logging
-from functools import reduce  # forward compatibility for Python 3
+import multiprocessing
+import os
+import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, islice
+
+try:
+    import cloudpickle
+except ImportError:  # Optional, transform_parallel runs in-process without it.
+    cloudpickle = None
+
+TRANSFORM = "transform"
+SUBSET = "subset"
+EXCLUSIVE_SUBSET = "exclusive_subset"
+
+PATH_CACHE_SIZE = 4096
 
 
 class Transformer:
     def __init__(self, transform_map):
         self.transform_map = transform_map
+        self._compiled = None
+        self._compiled_subsets = {}
 
     # Takes item and runs it trough provided mapping.
     # Leaves unmapped keys as is.
@@ -33,6 +52,132 @@ class Transformer:
             return safe_dot_get(item, transformation)
         raise ValueError(f"Type of transformation is wrong {type(transformation)}")
 
+    # Turns the mapping into a tree of prebuilt callables, with dotted paths parsed once.
+    # The returned function gives the same output as transform, without walking the mapping per item.
+    # The result is cached, so changes made to transform_map after the first call are not picked up.
+    def compile(self):
+        if self._compiled is None:
+            root = []  # Filled in below, lets falsy nodes refer back to the whole mapping like transform does.
+
+            def whole_map(item):
+                return root[0](item)
+
+            root.append(self.compile_node(self.transform_map, whole_map))
+            self._compiled = root[0]
+        return self._compiled
+
+    def compile_node(self, transformation, whole_map):
+        if not transformation:
+            return whole_map
+
+        if isinstance(transformation, Transformer):
+            return transformation.compile()
+        if isinstance(transformation, dict):
+            return compile_dict([(k, self.compile_node(v, whole_map)) for k, v in transformation.items()])
+        if isinstance(transformation, list):
+            return compile_list([self.compile_node(v, whole_map) for v in transformation])
+        if isinstance(transformation, tuple):
+            return compile_pipeline([self.compile_node(v, whole_map) for v in transformation])
+        if callable(transformation):
+            return transformation
+        if isinstance(transformation, str):
+            return compile_safe_path(transformation)
+        raise ValueError(f"Type of transformation is wrong {type(transformation)}")
+
+    # Returns the per item function used by the batch methods for the given mode.
+    def item_function(self, mode=TRANSFORM):
+        if mode == TRANSFORM:
+            return self.compile()
+        if mode == SUBSET:
+            return self.compile_subset()
+        if mode == EXCLUSIVE_SUBSET:
+            return self.compile_subset(exclusive=True)
+        raise ValueError(f"Unknown transform mode {mode}")
+
+    # Lazily transforms every item of an iterable, one result per item.
+    # Nothing is read from items until the generator is consumed, so memory stays flat for any input size.
+    # In exclusive_subset mode failures are recorded in report instead of logged, when one is given.
+    def transform_iter(self, items, mode=TRANSFORM, report=None):
+        fn = self.item_function(mode)
+        if mode == EXCLUSIVE_SUBSET and report is not None:
+            return (fn(item, report) for item in items)
+        return map(fn, items)
+
+    # Lazily transforms an iterable in chunks. Yields lists of at most chunk_size results,
+    # suitable for bulk writes such as insert_many.
+    # In exclusive_subset mode failures are collected per chunk and logged once per chunk.
+    # Pass a TransformErrorReport as report to get every chunk's failures merged into it.
+    def transform_many(self, items, chunk_size=500, mode=TRANSFORM, report=None):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if mode == EXCLUSIVE_SUBSET:
+            for chunk in iter_chunks(items, chunk_size):
+                results, chunk_report = self.exclusive_transform_batch(chunk)
+                if report is not None:
+                    report.merge(chunk_report)
+                yield results
+            return
+        fn = self.item_function(mode)
+        for chunk in iter_chunks(items, chunk_size):
+            yield [fn(item) for item in chunk]
+
+    # Transforms an iterable on a pool of worker processes and yields the results in input order.
+    # The mapping is sent to the workers with cloudpickle, so mappings containing lambdas and closures
+    # (if_not_empty, switch, for_each, ...) work. Workers are started with forkserver, or spawn where it is
+    # missing, never forked from the caller: the Functions worker runs gRPC threads and holds open sockets,
+    # and forking a multithreaded process can deadlock on locks held at fork time.
+    # Inputs with fewer than threshold items, or without cloudpickle installed, are transformed in-process.
+    # At most two chunks per worker are in flight, so memory stays bounded for any input size.
+    # In exclusive_subset mode the failures of every chunk are merged into report, when one is given.
+    def transform_parallel(self, items, mode=TRANSFORM, processes=None, chunk_size=500, threshold=5000, report=None):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        self.item_function(mode)  # Validates mode before any worker is started.
+        iterator = iter(items)
+        head = list(islice(iterator, threshold))
+        processes = processes or os.cpu_count() or 1
+        if len(head) < threshold or processes < 2 or cloudpickle is None:
+            yield from self.transform_iter_chunked(chain(head, iterator), chunk_size, mode, report)
+            return
+
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        pool = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_parallel_worker,
+            initargs=(cloudpickle.dumps(Transformer(self.transform_map)), mode),
+        )
+        with pool:
+            in_flight = deque()
+            for chunk in iter_chunks(chain(head, iterator), chunk_size):
+                in_flight.append(pool.submit(_transform_chunk, chunk))
+                if len(in_flight) >= processes * 2:
+                    yield from self.chunk_results(in_flight.popleft().result(), mode, report)
+            while in_flight:
+                yield from self.chunk_results(in_flight.popleft().result(), mode, report)
+
+    def transform_iter_chunked(self, items, chunk_size, mode, report=None):
+        for results in self.transform_many(items, chunk_size, mode, report):
+            yield from results
+
+    @staticmethod
+    def chunk_results(results, mode, report=None):
+        if mode == EXCLUSIVE_SUBSET:
+            results, chunk_report = results
+            chunk_report.log()
+            if report is not None:
+                report.merge(chunk_report)
+        return results
+
+    # Runs exclusive_transform_to_subset over a batch and collects the dropped keys in one report.
+    # The report is logged once for the whole batch and returned alongside the results.
+    def exclusive_transform_batch(self, items, id_keys=("id", "_id"), max_samples=5):
+        report = TransformErrorReport(id_keys=id_keys, max_samples=max_samples)
+        fn = self.compile_subset(exclusive=True)
+        results = [fn(item, report) for item in items]
+        report.log()
+        return results, report
+
     def transform_dict(self, item, transformation):
         return {k: self.transform(item, v) for k, v in transformation.items()}
 
@@ -42,18 +187,22 @@ class Transformer:
     # Takes item and runs it trough provided mapping.
     # Returns a subset of the input. Only the mapped values.
     def transform_to_subset(self, item):
-        result = {}
-        for key, mapping in self.transform_map.items():
-            # value = item[key]
-            result = {**result, **self.transform_key(key, mapping, item)}
-        return result
-
-    def exclusive_transform_to_subset(self, item):
-        result = {}
-        for key, mapping in self.transform_map.items():
-            # value = item[key]
-            result = {**result, **self.exclusive_transform_key(key, mapping, item)}
-        return result
+        return self.compile_subset()(item)
+
+    def exclusive_transform_to_subset(self, item, report=None):
+        return self.compile_subset(exclusive=True)(item, report)
+
+    # Compiles the subset mapping into one function that fills the result dict in a single pass.
+    # Keeps the semantics of transform_key: "method" wins over "from", "function" is applied to the
+    # looked up value and DropKey leaves the key out. Cached like compile.
+    def compile_subset(self, exclusive=False):
+        if exclusive not in self._compiled_subsets:
+            entries = tuple((key, compile_subset_value(mapping)) for key, mapping in self.transform_map.items())
+            if exclusive:
+                self._compiled_subsets[exclusive] = compile_exclusive_subset(entries)
+            else:
+                self._compiled_subsets[exclusive] = compile_subset(entries)
+        return self._compiled_subsets[exclusive]
 
     # Will drop keys that couldn't be found
     def exclusive_transform_key(self, key, mapping, item):
@@ -81,6 +230,163 @@ class Transformer:
             return {}
 
 
+_PARALLEL_TRANSFORMER = None
+_PARALLEL_MODE = None
+
+
+# The transformer arrives cloudpickled, unpickling it only needs cloudpickle to be importable in the worker.
+def _init_parallel_worker(pickled_transformer, mode):
+    global _PARALLEL_TRANSFORMER, _PARALLEL_MODE
+    _PARALLEL_TRANSFORMER = pickle.loads(pickled_transformer)
+    _PARALLEL_MODE = mode
+
+
+# Runs in a worker process. Exclusive subsets return their report so the parent can log it.
+def _transform_chunk(chunk):
+    if _PARALLEL_MODE == EXCLUSIVE_SUBSET:
+        fn = _PARALLEL_TRANSFORMER.compile_subset(exclusive=True)
+        report = TransformErrorReport()
+        return [fn(item, report) for item in chunk], report
+    fn = _PARALLEL_TRANSFORMER.item_function(_PARALLEL_MODE)
+    return [fn(item) for item in chunk]
+
+
+# Prebuilt equivalent of transform_key for one mapping, returns the value instead of a dict.
+# A mapping that can't be compiled fails when called, like transform_key would.
+def compile_subset_value(mapping):
+    try:
+        meth = mapping.get("method")
+        if meth:
+            return meth
+        get = compile_path(mapping["from"])
+        fun = mapping.get("function")
+        if fun:
+            return lambda item: fun(get(item))
+        return get
+    except Exception as e:
+        error = e
+
+        def fail(item):
+            raise error
+
+        return fail
+
+
+def compile_subset(entries):
+    def subset(item):
+        result = {}
+        for key, fn in entries:
+            try:
+                result[key] = fn(item)
+            except DropKey:
+                pass
+        return result
+
+    return subset
+
+
+# Will drop keys that couldn't be found.
+# Failures are recorded in report when one is given, otherwise logged one by one.
+def compile_exclusive_subset(entries):
+    def exclusive_subset(item, report=None):
+        result = {}
+        for key, fn in entries:
+            try:
+                result[key] = fn(item)
+            except DropKey:
+                pass
+            except Exception as e:
+                if report is None:
+                    logging.warn("Transformer raised an execption. Ignoring intentionally.")
+                    logging.warn(e)
+                else:
+                    report.record(key, item, e)
+        if report is not None:
+            report.items += 1
+        return result
+
+    return exclusive_subset
+
+
+class TransformErrorReport:
+    """
+    Compact summary of the keys an exclusive transform dropped during a batch.
+    Counts failures per (key, exception type) and keeps up to max_samples item ids for each.
+
+    :param id_keys: keys tried in order to find an id for the samples
+    :param max_samples: number of item ids kept per (key, exception type)
+    """
+
+    def __init__(self, id_keys=("id", "_id"), max_samples=5):
+        self.id_keys = id_keys
+        self.max_samples = max_samples
+        self.items = 0
+        self.counts = {}
+        self.samples = {}
+
+    # Adds the counts and samples of another report, keeping at most max_samples ids per error.
+    def merge(self, other):
+        self.items += other.items
+        for error, count in other.counts.items():
+            self.counts[error] = self.counts.get(error, 0) + count
+            samples = self.samples.setdefault(error, [])
+            samples.extend(other.samples[error][: max(self.max_samples - len(samples), 0)])
+        return self
+
+    def record(self, key, item, exception):
+        error = (key, type(exception).__name__)
+        self.counts[error] = self.counts.get(error, 0) + 1
+        samples = self.samples.setdefault(error, [])
+        if len(samples) < self.max_samples:
+            samples.append(self.item_id(item))
+
+    def item_id(self, item):
+        if isinstance(item, dict):
+            for id_key in self.id_keys:
+                if item.get(id_key) is not None:
+                    return item[id_key]
+        return None
+
+    @property
+    def failures(self):
+        return sum(self.counts.values())
+
+    def as_dict(self):
+        return {
+            "items": self.items,
+            "failures": self.failures,
+            "errors": [
+                {"key": key, "exception": exception, "count": count, "sample_ids": self.samples[(key, exception)]}
+                for (key, exception), count in self.counts.items()
+            ],
+        }
+
+    def log(self):
+        if not self.counts:
+            return
+        summary = ", ".join(
+            f"{key}/{exception} x{count} (e.g. {self.samples[(key, exception)]})"
+            for (key, exception), count in self.counts.items()
+        )
+        logging.warning(
+            "Transformer dropped %d keys while transforming %d items. Ignoring intentionally: %s",
+            self.failures,
+            self.items,
+            summary,
+        )
+
+
+def iter_chunks(items, chunk_size):
+    """
+    Splits an iterable into lists of at most chunk_size elements without reading ahead more than one chunk.
+    """
+    iterator = iter(items)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
+
+
 def OR_DROPKEY(func):
     def wrapper(arg):
         res = func(arg)
@@ -117,15 +423,10 @@ class DropKey(Exception):
 def safe_dot_get(root, lookup):
     if root is None:
         return None
-    try:
-        return dot_get(root, lookup)
-    except KeyError:
-        return None
-    except TypeError:
-        return None
+    return compile_safe_path(lookup)(root)
 
 
-def dot_get(root, lookup):
+def parse_path(lookup):
     items = lookup.split(".")
     _items = []
     for i in items:
@@ -133,7 +434,91 @@ def dot_get(root, lookup):
             _items.append(int(i))
         except:
             _items.append(i)
-    return reduce(operator.getitem, _items, root)
+    return tuple(_items)
+
+
+# Prebuilt equivalent of dot_get for a fixed lookup.
+# Cached per lookup string, list index segments are converted once.
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def compile_path(lookup):
+    path = parse_path(lookup)
+    if len(path) == 1:
+        return operator.itemgetter(path[0])
+
+    def get(root):
+        for key in path:
+            root = root[key]
+        return root
+
+    return get
+
+
+# Prebuilt equivalent of safe_dot_get for a fixed lookup.
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def compile_safe_path(lookup):
+    path = parse_path(lookup)
+    if len(path) == 1:
+        (first,) = path
+
+        def get(root):
+            if root is None:
+                return None
+            try:
+                return root[first]
+            except (KeyError, TypeError):
+                return None
+
+        return get
+
+    def get(root):
+        if root is None:
+            return None
+        try:
+            for key in path:
+                root = root[key]
+            return root
+        except (KeyError, TypeError):
+            return None
+
+    return get
+
+
+def compile_dict(compiled_items):
+    compiled_items = tuple(compiled_items)
+
+    def transform_dict(item):
+        return {k: fn(item) for k, fn in compiled_items}
+
+    return transform_dict
+
+
+def compile_list(compiled_items):
+    compiled_items = tuple(compiled_items)
+
+    def transform_list(item):
+        return [fn(item) for fn in compiled_items]
+
+    return transform_list
+
+
+def compile_pipeline(steps):
+    steps = tuple(steps)
+    if len(steps) == 1:
+        return steps[0]
+    if len(steps) == 2:
+        first, second = steps
+        return lambda item: second(first(item))
+
+    def pipeline(item):
+        for step in steps:
+            item = step(item)
+        return item
+
+    return pipeline
+
+
+def dot_get(root, lookup):
+    return compile_path(lookup)(root)
 
 
 def first_not_none(items):
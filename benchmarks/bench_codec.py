@@ -0,0 +1,86 @@
+"""
+Benchmarks for _lib/codec.py against the ExtendedEncoder/ExtendedDecoder it replaces
+
+Run from the repository root:
+    python -m benchmarks.bench_codec
+"""
+import json
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from _lib import codec
+from _lib.codec import serialize, deserialize, ExtendedEncoder, ExtendedDecoder
+
+
+def salary_row(i):
+    return {
+        "_id": f"employee-{i}",
+        "monthly_salary": Decimal("42000.00") + i,
+        "cost_price": Decimal("612.47"),
+        "pension": Decimal("0.045"),
+        "age": 25 + i % 40,
+        "updated": datetime(2023, 5, 1, 10, 0, 0) + timedelta(minutes=i),
+    }
+
+
+def lime_deal(i):
+    return {
+        "_id": i,
+        "name": f"Deal {i}",
+        "value": 1000 + i,
+        "dealstatus": {"key": "agreement", "text": "Agreement"},
+        "company": {"_id": 10 + i, "name": "Company AB", "address": {"city": "Stockholm", "zip": "11122"}},
+        "persons": [{"_id": 7, "name": "Per"}, {"_id": 8, "name": "Eva"}],
+        "_timestamp": "2023-05-01T10:00:00",
+    }
+
+
+PAYLOADS = {
+    # A queue message with a handful of typed values.
+    "message": {"queue": "costprice", "employee": salary_row(1), "sent": datetime(2023, 5, 1, 10, 0, 0)},
+    # A blob of typed rows.
+    "salary rows": [salary_row(i) for i in range(200)],
+    # A blob of plain JSON, no Decimal or datetime.
+    "deals": [lime_deal(i) for i in range(200)],
+}
+
+
+def old_serialize(item):
+    return json.dumps(item, cls=ExtendedEncoder)
+
+
+def old_deserialize(string):
+    return json.loads(string, cls=ExtendedDecoder)
+
+
+def bench(name, payload, number):
+    old_text, new_text = old_serialize(payload), serialize(payload)
+    assert deserialize(new_text) == old_deserialize(old_text) == payload
+    assert deserialize(old_text) == payload
+
+    timings = {}
+    for label, function, argument in [
+        ("old encode", old_serialize, payload),
+        ("new encode", serialize, payload),
+        ("old decode", old_deserialize, old_text),
+        ("new decode", deserialize, new_text),
+    ]:
+        timings[label] = min(timeit.repeat(lambda: function(argument), number=number, repeat=5)) / number
+    print(
+        f"{name:12s} size {len(old_text):7d} -> {len(new_text):7d} bytes ({len(old_text) / len(new_text):.2f}x), "
+        f"encode {timings['old encode'] * 1e6:9.2f} -> {timings['new encode'] * 1e6:9.2f} us "
+        f"({timings['old encode'] / timings['new encode']:.2f}x), "
+        f"decode {timings['old decode'] * 1e6:9.2f} -> {timings['new decode'] * 1e6:9.2f} us "
+        f"({timings['old decode'] / timings['new decode']:.2f}x)"
+    )
+
+
+def main(number=2000):
+    print(f"decode backend: {'orjson' if codec.orjson else 'json'}")
+    for name, payload in PAYLOADS.items():
+        bench(name, payload, number if name == "message" else number // 20)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmarks for _lib/transform.py
+
+Run from the repository root:
+    python -m benchmarks.bench_transform
+"""
+import operator
+import timeit
+from functools import reduce
+
+from _lib.transform import Transformer, if_not_empty, for_each, switch, is_none, default, constant, dot_get, safe_dot_get
+
+
+def lime_deal(i):
+    return {
+        "_id": i,
+        "name": f"Deal {i}",
+        "value": 1000 + i,
+        "dealstatus": {"key": "agreement", "text": "Agreement"},
+        "company": {"_id": 10 + i, "name": "Company AB", "address": {"city": "Stockholm", "zip": "11122"}},
+        "coworker": {"_id": 3, "name": "Anna"},
+        "persons": [{"_id": 7, "name": "Per"}, {"_id": 8, "name": "Eva"}],
+        "_timestamp": "2023-05-01T10:00:00",
+    }
+
+
+MAPPING = {
+    "id": "_id",
+    "name": "name",
+    "value": "value",
+    "status": ("dealstatus", "key"),
+    "company": {
+        "id": "company._id",
+        "name": "company.name",
+        "city": "company.address.city",
+        "zip": ("company.address.zip", if_not_empty(int)),
+    },
+    "responsible": "coworker.name",
+    "first_person": "persons.0.name",
+    "person_ids": ("persons", for_each(lambda p: p["_id"])),
+    "probability": ("probability", switch({is_none: constant(0), default: float})),
+    "timestamp": "_timestamp",
+}
+
+
+def wide_item(width):
+    return {f"field{i}": {"value": i, "text": str(i)} for i in range(width)}
+
+
+def wide_subset_mapping(width):
+    mapping = {}
+    for i in range(width):
+        if i % 3 == 0:
+            mapping[f"f{i}"] = {"from": f"field{i}.value", "function": str}
+        else:
+            mapping[f"f{i}"] = {"from": f"field{i}.text"}
+    return mapping
+
+
+# The subset builder as it was before compile_subset, merging one dict per mapped key.
+def merging_subset(transformer, item):
+    result = {}
+    for key, mapping in transformer.transform_map.items():
+        result = {**result, **transformer.transform_key(key, mapping, item)}
+    return result
+
+
+def bench_subset(width, number):
+    transformer = Transformer(wide_subset_mapping(width))
+    item = wide_item(width)
+    assert transformer.transform_to_subset(item) == merging_subset(transformer, item)
+
+    merging = min(timeit.repeat(lambda: merging_subset(transformer, item), number=number, repeat=5)) / number
+    single_pass = min(timeit.repeat(lambda: transformer.transform_to_subset(item), number=number, repeat=5)) / number
+    print(f"subset {width:3d} keys, merging:     {merging * 1e6:8.2f} us/item")
+    print(f"subset {width:3d} keys, single pass: {single_pass * 1e6:8.2f} us/item ({merging / single_pass:.2f}x)")
+
+
+# dot_get as it was before compile_path, parsing the lookup on every call.
+def parsing_dot_get(root, lookup):
+    items = []
+    for i in lookup.split("."):
+        try:
+            items.append(int(i))
+        except:
+            items.append(i)
+    return reduce(operator.getitem, items, root)
+
+
+def bench_dot_get(number):
+    item = lime_deal(1)
+    item["a"] = {"b": [{"c": {"d": {"e": [0, {"f": "deep"}]}}}]}
+    for name, lookup in [("shallow", "name"), ("nested", "company.address.city"), ("deep", "a.b.0.c.d.e.1.f")]:
+        assert dot_get(item, lookup) == safe_dot_get(item, lookup) == parsing_dot_get(item, lookup)
+        parsing = min(timeit.repeat(lambda: parsing_dot_get(item, lookup), number=number, repeat=5)) / number
+        cached = min(timeit.repeat(lambda: dot_get(item, lookup), number=number, repeat=5)) / number
+        safe = min(timeit.repeat(lambda: safe_dot_get(item, lookup), number=number, repeat=5)) / number
+        print(
+            f"dot_get {name:7s} parsing: {parsing * 1e6:6.2f} us, cached: {cached * 1e6:6.2f} us "
+            f"({parsing / cached:.2f}x), safe_dot_get: {safe * 1e6:6.2f} us"
+        )
+
+
+def main(number=20000):
+    transformer = Transformer(MAPPING)
+    compiled = transformer.compile()
+    items = [lime_deal(i) for i in range(100)]
+    assert [compiled(item) for item in items] == [transformer.transform(item) for item in items]
+
+    item = items[0]
+    interpreted = min(timeit.repeat(lambda: transformer.transform(item), number=number, repeat=5)) / number
+    precompiled = min(timeit.repeat(lambda: compiled(item), number=number, repeat=5)) / number
+    print(f"transform:  {interpreted * 1e6:8.2f} us/item")
+    print(f"compile():  {precompiled * 1e6:8.2f} us/item")
+    print(f"speedup:    {interpreted / precompiled:8.2f}x")
+
+    bench_subset(5, number)
+    bench_subset(80, number // 10)
+
+    bench_dot_get(number * 5)
+
+
+if __name__ == "__main__":
+    main()
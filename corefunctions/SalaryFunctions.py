@@ -0,0 +1,80 @@
+import azure.functions as func
+import logging
+import json
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from _lib.salary import CostPriceCalculator, CostModel
+
+CALCULATOR = CostPriceCalculator()
+
+
+class InvalidRow(Exception):
+    pass
+
+
+@lru_cache(maxsize=65536)
+def cached_cost_price(monthly_salary, age, income_base_amount) -> int:
+    return CostModel.get(income_base_amount).cost_price(monthly_salary, age)
+
+
+@lru_cache(maxsize=4096)
+def cached_cost_price_hourly_salary(hourly_salary) -> int:
+    return CALCULATOR.cost_price_hourly_salary(hourly_salary)
+
+
+# JSON numbers can arrive as floats, the calculator works on int and Decimal.
+def to_number(value):
+    if isinstance(value, bool):
+        raise InvalidRow(f"'{value}' is not a number")
+    if isinstance(value, int):
+        return value
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        raise InvalidRow(f"'{value}' is not a number")
+    if not number.is_finite():
+        raise InvalidRow(f"'{value}' is not a number")
+    return number
+
+
+# A row is either {"monthly_salary", "age", "income_base_amount"}, {"hourly_salary"},
+# [monthly_salary, age, income_base_amount] or [hourly_salary].
+def row_cost_price(row) -> int:
+    if isinstance(row, list):
+        if len(row) == 3:
+            row = dict(zip(("monthly_salary", "age", "income_base_amount"), row))
+        elif len(row) == 1:
+            row = {"hourly_salary": row[0]}
+    if not isinstance(row, dict):
+        raise InvalidRow(f"Unsupported row {row}")
+    try:
+        if "hourly_salary" in row:
+            return cached_cost_price_hourly_salary(to_number(row["hourly_salary"]))
+        return cached_cost_price(
+            to_number(row["monthly_salary"]), to_number(row["age"]), to_number(row["income_base_amount"])
+        )
+    except KeyError as e:
+        raise InvalidRow(f"Missing {e}")
+    except ArithmeticError:
+        # Numbers too large for Decimal to round, e.g. 1e300, raise InvalidOperation.
+        raise InvalidRow("Number out of range")
+
+
+def cost_price_HTTP(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        rows = req.get_json()
+    except ValueError:
+        return func.HttpResponse("Request body must be a JSON array of rows.", status_code=400)
+    if not isinstance(rows, list):
+        return func.HttpResponse("Request body must be a JSON array of rows.", status_code=400)
+
+    cost_prices = []
+    for i, row in enumerate(rows):
+        try:
+            cost_prices.append(row_cost_price(row))
+        except InvalidRow as e:
+            return func.HttpResponse(f"Row {i}: {e}", status_code=400)
+
+    info = cached_cost_price.cache_info()
+    logging.info("Calculated %d cost prices. Cache hits=%d, misses=%d", len(rows), info.hits, info.misses)
+    return func.HttpResponse(json.dumps(cost_prices), mimetype="application/json")
@@ -11,12 +11,22 @@ def TestFunctionHTTP(req: func.HttpRequest) -> func.HttpResponse:
     return test_function_HTTP(req)
 
 
+# Cost prices for a JSON array of salary rows in one call.
+@app.route(route="costPrice", methods=["POST"])
+def CostPriceHTTP(req: func.HttpRequest) -> func.HttpResponse:
+    from corefunctions.SalaryFunctions import cost_price_HTTP
+    return cost_price_HTTP(req)
+
+
+# Resolves claim check pointers, so "test-function" can be listed in the QueueClaimCheckQueues setting.
 @app.function_name(name="myTestFunctionQueue")
 @app.queue_trigger(arg_name="azqueue", queue_name="test-function",
                                connection="AzureWebJobsStorage") 
 def TestFunctionQueue(azqueue: func.QueueMessage):
     from corefunctions.TestFunctions import test_function_queue
-    test_function_queue(azqueue.get_body().decode('utf-8'))
+    from _lib.poison_triage import records_failures
+    from _lib.blob_service import claim_checked
+    records_failures("test-function")(claim_checked(test_function_queue))(azqueue.get_body().decode('utf-8'))
 
 
 @app.function_name(name="myTestFunctionTimer")
@@ -37,12 +47,14 @@ def TestFunctionSbQueue(azservicebus: func.ServiceBusMessage):
 
 
 # Standard function to keep messages in loop. Standard lenght of an untouched message i storage is 10 days.
+# Messages are triaged first: duplicates are dropped and messages that keep failing are archived to blob.
+# Storage queue triggers wrap their handler in records_failures, so triage knows why a message failed.
 @app.function_name(name="RetryAllPoison")
 @app.timer_trigger(schedule="0 0 3 * * 6", arg_name="myTimer", run_on_startup=True,
               use_monitor=False) 
 def RetryAllPoison(myTimer: func.TimerRequest) -> None:
-    from _lib.queue_service import retry_all_msg_in_poison
-    retry_all_msg_in_poison()
+    from _lib.poison_triage import triage_all_poison
+    triage_all_poison()
 
 
 